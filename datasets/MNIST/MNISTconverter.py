@@ -4,7 +4,8 @@
 
 
 # This script will load the MNIST data (in its own format) and convert
-# it into numpy arrays.  It will also shuffle the data.  
+# it into numpy arrays.  It will also shuffle the data.  The images are
+# saved as uint8 pixels and the targets as integer class labels.
 # 
 #  For more info on the MNIST data format, see:
 #    http://yann.lecun.com/exdb/mnist/
@@ -12,130 +13,135 @@
 
 import os
 import sys
-import struct
 
 import numpy as np
 import scipy.io as sio
 
 
+## IDX type codes (the third byte of the magic number) and the numpy
+## types they map to.  Multi-byte types are stored big-endian.
+idxTypes = { 0x08: '>u1',  # unsigned byte
+             0x09: '>i1',  # signed byte
+             0x0B: '>i2',  # short
+             0x0C: '>i4',  # int
+             0x0D: '>f4',  # float
+             0x0E: '>f8' } # double
+
+
+def readIDX(fileName):
+    # IDX format is:
+    #  32-bit magic number:  two zero bytes, a type code, and the
+    #                        number of dimensions (eg: 0x00000803)
+    #  one 32-bit size per dimension
+    #    the data, in C order
+    #
+    # The file is memory-mapped, so nothing is read until it is used,
+    # and the result is a read-only view of the file.
+    raw = np.memmap(fileName, dtype='uint8', mode='r')
+    if raw.shape[0] < 4 or raw[0] != 0 or raw[1] != 0 or raw[2] not in idxTypes:
+        raise Exception("%s has the wrong magic number." % fileName)
+    dtype = np.dtype(idxTypes[raw[2]])
+    numDims = int(raw[3])
+    offset = 4 + 4 * numDims
+    if raw.shape[0] < offset:
+        raise Exception("%s has a truncated header." % fileName)
+    shape = tuple( int(d) for d in raw[4:offset].view('>i4') )
+    del raw
+
+    if ( os.path.getsize(fileName) != offset + dtype.itemsize * int(np.prod(shape)) ):
+        raise Exception("%s is the wrong size for its dimensions %s" % (fileName, shape))
+    return np.memmap(fileName, dtype=dtype, mode='r', offset=offset, shape=shape)
+
+
 def readImages( imagesFile, labelsFile):
-    # images format is:
-    #  32-bit magic number ( = 0x00000803 (2051) )
-    #  32-bit count
-    #  32-bit y-resolution (number of rows, like 28)
-    #  32-bit x-resolution (number of columns, like 28)
-    #    many (count * y-res * x-rex) 8-bit pixels
-    f = open(imagesFile,'rb');
-    f_mn = struct.unpack('>i', f.read(4))[0]
-    if (f_mn != 2051):
-        print "Error: Images file has the wrong magic number."
-    f_count = struct.unpack('>i', f.read(4))[0]
-    f_yRes = struct.unpack('>i', f.read(4))[0]
-    f_xRes = struct.unpack('>i', f.read(4))[0]
-    imageSize = f_xRes * f_yRes
-    if ( os.path.getsize(imagesFile) != f_count * imageSize + f.tell() ):
-        print "Error: Images file is the wrong size or resolution"
-
-    # labels format is:
-    #  32-bit magic number ( = 0x00000801 (2049) )
-    #  32-bit number of items
-    #    many (count) 8-bit labels
-    g = open(labelsFile,'rb');
-    g_mn = struct.unpack('>i', g.read(4))[0]
-    if (g_mn != 2049):
-        print "Error: Labels file has the wrong magic number."
-    g_count = struct.unpack('>i', g.read(4))[0]
-    if (g_count != f_count):
-        print "Error: Labels file has a different number of items from the images file"
-    if ( os.path.getsize(labelsFile) != g_count + g.tell() ):
-        print "Error:  Labels file is the wrong size"
-
-    images = range(10)
-    for i in range(len(images)):
-        images[i] = []
-    unpackFmt = str(f_xRes * f_yRes) + 'B'
-    for label in g.read():
-        rawImage = f.read(imageSize)
-        image =struct.unpack( unpackFmt, rawImage)
-        images[ ord(label) ].append(image)
-    #numpy-ize it:
-    numpyImages = []
-    for i in range(len(images)):
-        numpyImages.append( np.array(images[i], dtype='uint8') )
-
-    return numpyImages
-
-
-
-
-def stackAndShuffle(imagesByLabel):
-    # Re-stack the training data into a single array:
-    imagesStacked = np.vstack(( imagesByLabel))
-
-    # Go from uint8 to float64; scale to 1.0:
-    imagesStacked = imagesStacked/255.
-
-    # Create the output target set based on the labels:
-    targets = np.vstack(( np.tile([1, 0, 0, 0, 0, 0, 0, 0, 0, 0], (imagesByLabel[0].shape[0], 1)),
-                          np.tile([0, 1, 0, 0, 0, 0, 0, 0, 0, 0], (imagesByLabel[1].shape[0], 1)),
-                          np.tile([0, 0, 1, 0, 0, 0, 0, 0, 0, 0], (imagesByLabel[2].shape[0], 1)),
-                          np.tile([0, 0, 0, 1, 0, 0, 0, 0, 0, 0], (imagesByLabel[3].shape[0], 1)),
-                          np.tile([0, 0, 0, 0, 1, 0, 0, 0, 0, 0], (imagesByLabel[4].shape[0], 1)),
-                          np.tile([0, 0, 0, 0, 0, 1, 0, 0, 0, 0], (imagesByLabel[5].shape[0], 1)),
-                          np.tile([0, 0, 0, 0, 0, 0, 1, 0, 0, 0], (imagesByLabel[6].shape[0], 1)),
-                          np.tile([0, 0, 0, 0, 0, 0, 0, 1, 0, 0], (imagesByLabel[7].shape[0], 1)),
-                          np.tile([0, 0, 0, 0, 0, 0, 0, 0, 1, 0], (imagesByLabel[8].shape[0], 1)),
-                          np.tile([0, 0, 0, 0, 0, 0, 0, 0, 0, 1], (imagesByLabel[9].shape[0], 1))  ))
-
-    numImages = imagesStacked.shape[0]
+    # images file is an IDX file with dimensions (count, y-res, x-res),
+    # eg: (60000, 28, 28) of 8-bit pixels.  Any type and any number of
+    # dimensions after the count will do; each image is flattened
+    # into one row.
+    images = readIDX(imagesFile)
+    if len(images.shape) < 2:
+        raise Exception("Images file should have at least 2 dimensions.")
+    count = images.shape[0]
+    images = images.reshape(count, int(np.prod(images.shape[1:])))
+
+    # labels file is a 1-D IDX file with one 8-bit label per image.
+    labels = readIDX(labelsFile)
+    if len(labels.shape) != 1:
+        raise Exception("Labels file should have 1 dimension.")
+    if (labels.shape[0] != count):
+        raise Exception("Labels file has a different number of items from the images file")
+
+    return images, labels
+
+
+
+
+def stackAndShuffle(images, labels):
+    numImages = images.shape[0]
     print 'Size of this dataset: ', numImages
 
+    # Sort the data by label (keeping the file order within each label),
+    # then shuffle it.  This gives the same permutation as stacking
+    # all the zeros, then all the ones, etc, before shuffling.
+    byLabel = np.argsort(labels, kind='mergesort')
+
     ## Shuffle the training data:
     np.random.seed(0) #so we know the permutation of the training data
-    randomOrder = np.random.permutation(numImages)
-    newImages = imagesStacked[randomOrder, :]
-    newTargets = targets[randomOrder, :]
+    randomOrder = byLabel[np.random.permutation(numImages)]
 
-    return {'images': newImages, 'targets': newTargets }
+    # The images stay as uint8 pixels and the targets as integer class
+    # labels.  Scaling to 1.0 and expanding the labels into one-hot
+    # target vectors is done one batch at a time by the training code
+    # (see rbm-cd/datasetUtils.py).
+    newImages = np.ascontiguousarray(images[randomOrder, :])
+    newLabels = np.ascontiguousarray(labels[randomOrder])
+
+    return {'images': newImages, 'labels': newLabels }
 
 
 
 def usageAndExit():
-    sys.stderr.write('Usage:  ' + sys.argv[0] + ' train|test\n')
+    sys.stderr.write('Usage:  ' + sys.argv[0] + ' train|test [mat]\n')
     sys.exit(1)
 
 
-if len(sys.argv) != 2:
+if len(sys.argv) not in (2, 3):
     usageAndExit()
 
 if sys.argv[1] == 'train':
     imageFile = 'train-images-idx3-ubyte'
     labelFile = 'train-labels-idx1-ubyte'
-    outFileName = 'trainImagesAndTargets.mat'
+    outBaseName = 'trainImagesAndTargets'
 
 elif sys.argv[1] == 'test':
     imageFile = 't10k-images-idx3-ubyte'
     labelFile = 't10k-labels-idx1-ubyte'
-    outFileName = 'testImagesAndTargets.mat'
+    outBaseName = 'testImagesAndTargets'
 
 else:
     usageAndExit()
 
+if len(sys.argv) == 3 and sys.argv[2] != 'mat':
+    usageAndExit()
+
 
 print "Loading the " + sys.argv[1] + "ing images...",
 sys.stdout.flush()
-imagesByLabel = readImages(imageFile, labelFile)
+(images, labels) = readImages(imageFile, labelFile)
 print " done."
 
-## imagesByLabel[0] should all look like zeros
-## imagesByLabel[1] should all look like ones
-## imagesByLabel[2] should all look like twos
-##  ...etc
-
 print "Stacking and shuffling the data..."
-shuffledDataset = stackAndShuffle(imagesByLabel)
+shuffledDataset = stackAndShuffle(images, labels)
 
+## The data is saved as one .npy file per array, so the training scripts
+## can memory-map it instead of parsing and copying it.  (See
+## rbm-cd/datasetUtils.py.)
 print "Saving the data..."
-sio.savemat(outFileName, shuffledDataset, oned_as='row')
+for key in shuffledDataset:
+    np.save('%s-%s.npy' % (outBaseName, key), shuffledDataset[key])
+
+## The .mat file is only written on request, eg: for use from Matlab.
+if len(sys.argv) == 3:
+    sio.savemat(outBaseName + '.mat', shuffledDataset, oned_as='row')
 
 print "Done."
@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+import numpy as np
+from scipy.linalg.blas import get_blas_funcs
+
+from randomStreams import uniform
+
+
+## Contrastive Divergence for one layer of the network, like
+## LogisticHinton2006.cd1(), but with k steps of Gibbs sampling (CD-k),
+## and optionally with persistent chains (PCD, Tieleman 2008):  instead
+## of starting the negative phase from each batch's data, it continues
+## the chains ("fantasy particles") left by the previous batch, which
+## mix much better than a few steps from the data.
+##
+## Every array (the hidden probabilities and states, the chains, the
+## random numbers and the parameter changes) is allocated once, up
+## front, for batches of up to maxBatchSize cases.  The returned arrays
+## are views of those buffers, so they are overwritten by the next call.
+##
+## cd() returns the changes to the parameters, like cd1() (and with k=1
+## and persistent=False, exactly the same ones).  train() goes further,
+## and applies them, with momentum, without any temporaries:  it builds
+## the momentum-smoothed step ("velocity") straight from the positive
+## and negative statistics with BLAS gemm's beta accumulation
+##    velocity = momentum * velocity + alpha * (data' hidprobs)
+## and adds the weight decay with axpy, before the weights take the
+## step in place.  (It rounds differently from cd() + batchCD1's old
+## update, so the results agree to rounding, not bit for bit.)
+
+class CDSampler:
+    def __init__(self, nn, whichLayer, maxBatchSize, k=1, persistent=False):
+        self.nn = nn
+        self.whichLayer = whichLayer
+        self.maxBatchSize = maxBatchSize
+        self.k = k
+        self.persistent = persistent
+
+        self.epsilonW = 0.1
+        self.epsilonVB = 0.1
+        self.epsilonHB = 0.1
+        self.weightcost = 0.0002
+
+        dtype = nn.dtype
+        (numvis, numhid) = nn.W[whichLayer].shape
+        self.posHidProbs = np.empty((maxBatchSize, numhid), dtype)
+        self.hidStates = np.empty((maxBatchSize, numhid), dtype)
+        self.negData = np.empty((maxBatchSize, numvis), dtype)
+        self.negHidProbs = np.empty((maxBatchSize, numhid), dtype)
+        ## (The random numbers are compared with the probabilities in
+        ## double precision, as cd1() does.)
+        self.randomNumbers = np.empty((maxBatchSize, numhid), np.float64)
+        self.visScratch = np.empty((maxBatchSize, numvis), dtype)
+
+        self.reconStates = np.empty((maxBatchSize, numhid), dtype)
+
+        self.deltaW = np.empty((numvis, numhid), dtype)
+        self.negProds = np.empty((numvis, numhid), dtype)
+        self.deltaVB = np.empty((1, numvis), dtype)
+        self.negVisAct = np.empty((1, numvis), dtype)
+        self.deltaHB = np.empty((1, numhid), dtype)
+        self.negHidAct = np.empty((1, numhid), dtype)
+
+        ## For train():  the momentum-smoothed steps, and BLAS routines
+        ## of the right precision.
+        self.velocityW = np.zeros((numvis, numhid), dtype)
+        self.velocityVB = np.zeros((1, numvis), dtype)
+        self.velocityHB = np.zeros((1, numhid), dtype)
+        (self.gemm, self.axpy) = get_blas_funcs(('gemm', 'axpy'), (self.velocityW,))
+
+        ## For PCD:  the chains' hidden states, one chain per case of a
+        ## full batch, started from the first batch's data.
+        self.chainsStarted = False
+
+    def flops(self, numcases):
+        ## The floating-point operations (a multiply and an add each) in
+        ## the matrix products of one cd() or train() on numcases cases:
+        ## up and the statistics for the data, k steps down and up and
+        ## the statistics for the chains, and the reconstruction for PCD.
+        (numvis, numhid) = self.nn.W[self.whichLayer].shape
+        if self.persistent:
+            products = 3 * numcases + (2 * self.k + 1) * self.maxBatchSize
+        else:
+            products = (2 * self.k + 3) * numcases
+        return 2. * products * numvis * numhid
+
+    #### What must be saved to resume training exactly:  the momentum,
+    #### and the chains.
+    stateNames = ['velocityW', 'velocityVB', 'velocityHB', 'hidStates', 'chainsStarted']
+
+    def getState(self):
+        return [ np.asarray(getattr(self, name)) for name in self.stateNames ]
+
+    def setState(self, arrays):
+        ## arrays is a dictionary of the arrays from getState(), by name.
+        for name in self.stateNames[:4]:
+            getattr(self, name)[...] = arrays[name]
+        self.chainsStarted = bool(arrays['chainsStarted'])
+
+    #### In place logistic units:  out = 1/(1 + exp(-(x W + b)))
+
+    def logistic(self, out):
+        np.negative(out, out=out)
+        np.exp(out, out=out)
+        out += 1.
+        np.reciprocal(out, out=out)
+        return out
+
+    def up(self, inputData, out):
+        np.dot(inputData, self.nn.W[self.whichLayer], out=out)
+        out += self.nn.hB[self.whichLayer]
+        return self.logistic(out)
+
+    def down(self, hidStates, out):
+        np.dot(hidStates, self.nn.W[self.whichLayer].T, out=out)
+        out += self.nn.vB[self.whichLayer]
+        return self.logistic(out)
+
+    def sample(self, probs, rng, out):
+        ## Binary states (0. or 1.), sampled straight into a float buffer.
+        randomNumbers = uniform(rng, probs.shape, out=self.randomNumbers[:probs.shape[0]])
+        np.greater(probs, randomNumbers, out=out)
+        return out
+
+    def gibbs(self, inputData, rng):
+        ## The positive phase, and k steps of Gibbs sampling for the
+        ## negative phase.  Returns (poshidprobs, negdata, neghidprobs,
+        ## beliefError).
+        numcases = inputData.shape[0]
+        assert numcases <= self.maxBatchSize, "Batch is bigger than maxBatchSize."
+        assert inputData.dtype == self.nn.dtype
+
+        #### Positive Phase:
+        poshidprobs = self.up(inputData, self.posHidProbs[:numcases])
+
+        if self.persistent:
+            numchains = self.maxBatchSize
+            hidStates = self.hidStates
+            if not self.chainsStarted:
+                ## Start the chains from this batch (repeated, if it is
+                ## smaller than a full batch):
+                states = self.sample(poshidprobs, rng, self.hidStates[:numcases])
+                np.take(states, np.arange(numchains), axis=0, mode='wrap', out=hidStates)
+                self.chainsStarted = True
+        else:
+            numchains = numcases
+            hidStates = self.sample(poshidprobs, rng, self.hidStates[:numcases])
+        negdata = self.negData[:numchains]
+        neghidprobs = self.negHidProbs[:numchains]
+
+        #### Negative Phase:  k steps of Gibbs sampling.
+        for step in range(self.k):
+            if step > 0:
+                self.sample(neghidprobs, rng, hidStates)
+            self.down(hidStates, negdata)  # What does the network believe?
+            self.up(negdata, neghidprobs)
+
+        #### How well does the network reconstruct the data?
+        reconstruction = self.visScratch[:numcases]
+        if self.persistent:
+            ## Move the chains on, for the next batch:
+            self.sample(neghidprobs, rng, hidStates)
+            ## The chains have nothing to do with the data, so this takes
+            ## one more step, down from the positive phase:
+            states = self.sample(poshidprobs, rng, self.reconStates[:numcases])
+            self.down(states, reconstruction)
+            np.subtract(inputData, reconstruction, out=reconstruction)
+        else:
+            np.subtract(inputData, negdata, out=reconstruction)
+        np.square(reconstruction, out=reconstruction)
+        beliefError = reconstruction.sum(0).sum(0)
+
+        return poshidprobs, negdata, neghidprobs, beliefError
+
+    def cd(self, inputData, rng=None):
+        ## Returns the same (lDeltaW, lDeltaVB, lDeltaHB, poshidprobs,
+        ## beliefError) as cd1().  rng is a random stream (see
+        ## randomStreams.py), or None for numpy's global random state.
+        (poshidprobs, negdata, neghidprobs, beliefError) = self.gibbs(inputData, rng)
+        numcases = inputData.shape[0]
+        numchains = negdata.shape[0]
+        W = self.nn.W[self.whichLayer]
+
+        np.dot(inputData.T, poshidprobs, out=self.deltaW)  # <v_i, h_j>_data
+        np.sum(inputData, axis=0, out=self.deltaVB[0])
+        np.sum(poshidprobs, axis=0, out=self.deltaHB[0])
+        np.dot(negdata.T, neghidprobs, out=self.negProds)
+        np.sum(negdata, axis=0, out=self.negVisAct[0])
+        np.sum(neghidprobs, axis=0, out=self.negHidAct[0])
+
+        if self.persistent:
+            ## The data and the chains are averaged separately:
+            self.deltaW /= numcases; self.negProds /= numchains
+            self.deltaW -= self.negProds
+            self.deltaVB /= numcases; self.negVisAct /= numchains
+            self.deltaVB -= self.negVisAct
+            self.deltaHB /= numcases; self.negHidAct /= numchains
+            self.deltaHB -= self.negHidAct
+            scaleVB = self.epsilonVB
+            scaleHB = self.epsilonHB
+        else:
+            self.deltaW -= self.negProds
+            self.deltaW /= numcases
+            self.deltaVB -= self.negVisAct
+            self.deltaHB -= self.negHidAct
+            scaleVB = self.epsilonVB / numcases
+            scaleHB = self.epsilonHB / numcases
+
+        # Reduce the probability incorrect beliefs (with weight decay):
+        np.multiply(W, self.weightcost, out=self.negProds)
+        self.deltaW -= self.negProds
+        self.deltaW *= self.epsilonW
+        # Renormalize the biases:
+        self.deltaVB *= scaleVB
+        self.deltaHB *= scaleHB
+
+        return self.deltaW, self.deltaVB, self.deltaHB, poshidprobs, beliefError
+
+    def train(self, inputData, momentum, rng=None):
+        ## One step of training on a batch, in place.  Returns
+        ## (poshidprobs, beliefError).
+        (poshidprobs, negdata, neghidprobs, beliefError) = self.gibbs(inputData, rng)
+        numcases = inputData.shape[0]
+        numchains = negdata.shape[0]
+        W = self.nn.W[self.whichLayer]
+        gemm = self.gemm
+
+        ## The weights' velocity.  Fortran's gemm only writes a
+        ## column-major result in place, and velocityW.T is one, so we
+        ## compute the transposed products:  hidprobs' data.  (The
+        ## transposes of our row-major batches are column-major too, so
+        ## nothing is copied.)
+        ##   velocity = momentum * velocity
+        ##              + epsilonW * (<v h>_data / numcases - <v h>_model / numchains
+        ##                            - weightcost * W)
+        vT = self.velocityW.T
+        epsilonW = self.epsilonW
+        gemm(epsilonW / numcases, poshidprobs.T, inputData.T, beta=momentum,
+             c=vT, trans_b=1, overwrite_c=1)
+        gemm(-epsilonW / numchains, neghidprobs.T, negdata.T, beta=1.,
+             c=vT, trans_b=1, overwrite_c=1)
+        self.axpy(W.ravel(), self.velocityW.ravel(), a=-epsilonW * self.weightcost)
+
+        ## The biases' velocity (these are small):
+        for (velocity, posData, negData, epsilon, scratch) in (
+                (self.velocityVB, inputData, negdata, self.epsilonVB, self.negVisAct),
+                (self.velocityHB, poshidprobs, neghidprobs, self.epsilonHB, self.negHidAct)):
+            velocity *= momentum
+            np.sum(posData, axis=0, out=scratch[0])
+            scratch *= epsilon / numcases
+            velocity += scratch
+            np.sum(negData, axis=0, out=scratch[0])
+            scratch *= epsilon / numchains
+            velocity -= scratch
+
+        # (In place:  the weights are views of nn.parameters.)
+        W += self.velocityW
+        self.nn.vB[self.whichLayer] += self.velocityVB
+        self.nn.hB[self.whichLayer] += self.velocityHB
+        return poshidprobs, beliefError
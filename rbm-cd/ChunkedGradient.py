@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+
+## backprop() computes the whole batch in one go, so its memory use
+## (batch x 2000 activations for the widest layer, and more for the
+## temporaries) grows with the batch.  This wraps backprop() (or
+## backprop_only3(), or anything else with the same arguments) so that
+## the cases are split into chunks of at most chunkSize, and the
+## chunks' errors and gradients are summed.  The result is the same
+## (f, df), to rounding, but the memory use is bounded by the chunk size.
+##
+## The chunks are shared out between numThreads threads.  numpy lets go
+## of the GIL during the matrix products (and most other big array
+## operations), so the threads run in parallel.  (If BLAS is itself
+## multi-threaded, it may be best to limit it to one thread, eg with
+## OPENBLAS_NUM_THREADS=1, when numThreads is the number of cores.)
+##
+## Each thread sums its chunks' gradients in its own buffers, which are
+## allocated the first time, and the total goes into a preallocated
+## gradient buffer:  the df that is returned is overwritten by the next
+## call (minimize() and lbfgs() copy it).  Use it in place of backprop:
+##    gradient = ChunkedGradient(backprop, 1000)
+##    nn.minimizeAllLayers(data, targets, max_iter, gradient=gradient)
+
+class ChunkedGradient:
+    def __init__(self, f, chunkSize=1000, numThreads=None):
+        self.f = f
+        self.chunkSize = chunkSize
+        if numThreads is None:
+            numThreads = multiprocessing.cpu_count()
+        self.numThreads = numThreads
+        self.pool = ThreadPool(numThreads) if numThreads > 1 else None
+        self.sums = None
+
+    def allocate(self, VV):
+        ## For each thread, the sum of its gradients, and a buffer for
+        ## the gradient of one chunk.  And the total.
+        self.sums = [ np.empty_like(VV) for t in range(self.numThreads) ]
+        self.chunkGradients = [ np.empty_like(VV) for t in range(self.numThreads) ]
+        self.df = np.empty_like(VV)
+
+    def __call__(self, VV, Dim, inputs, targets, df=None):
+        if self.sums is None or self.df.shape != VV.shape or self.df.dtype != VV.dtype:
+            self.allocate(VV)
+        numcases = inputs.shape[0]
+        starts = range(0, numcases, self.chunkSize)
+        numThreads = min(self.numThreads, len(starts))
+
+        def work(t):
+            ## Thread t does chunks t, t + numThreads, ...
+            f = 0.
+            for (i, start) in enumerate(starts[t::numThreads]):
+                stop = min(start + self.chunkSize, numcases)
+                if i == 0:
+                    gradient = self.sums[t]
+                else:
+                    gradient = self.chunkGradients[t]
+                (chunkF, chunkDf) = self.f(VV, Dim, inputs[start:stop], targets[start:stop],
+                                           df=gradient)
+                f += chunkF
+                if i > 0:
+                    self.sums[t] += chunkDf
+            return f
+
+        if numThreads > 1:
+            fs = self.pool.map(work, range(numThreads))
+        else:
+            fs = [ work(0) ]
+
+        if df is None:
+            df = self.df
+        df[...] = self.sums[0]
+        for t in range(1, numThreads):
+            df += self.sums[t]
+        return sum(fs), df
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+from InferenceEngine import InferenceEngine
+from telemetry import record
+
+
+## Scores a network on a whole dataset:  the number of misclassified
+## cases and the summed cross-entropy error, in one pass.  The cases
+## are taken in batches of up to batchSize, straight from the (uint8,
+## possibly memory-mapped) images and integer labels, and the batches
+## are shared out between numThreads threads.  Each thread has its own
+## InferenceEngine (and buffers), and they all read the same weights,
+## which must not change during evaluate().  numpy lets go of the GIL
+## for the matrix products and the logistic function, so the threads
+## run in parallel.
+
+class Evaluator:
+    def __init__(self, nn, batchSize=1000, numThreads=None):
+        self.nn = nn
+        self.batchSize = batchSize
+        if numThreads is None:
+            numThreads = multiprocessing.cpu_count()
+        self.numThreads = numThreads
+        self.pool = ThreadPool(numThreads) if numThreads > 1 else None
+
+        numClasses = nn.W[3].shape[1]
+        self.engines = [ InferenceEngine(nn, batchSize) for t in range(numThreads) ]
+        self.targets = [ np.empty((batchSize, numClasses), nn.dtype)
+                         for t in range(numThreads) ]
+        self.rawBuffers = [ {} for t in range(numThreads) ]
+        self.caseIndex = np.arange(batchSize)
+
+    def evaluate(self, images, labels, cases=None):
+        ## Returns (numErrors, crossEntropy, numCases).  With 'cases' (an
+        ## array of indices, eg a fixed random sample), only those cases
+        ## are scored.  (Also reported to telemetry, as an 'eval' record.)
+        tStart = time.time()
+        if cases is None:
+            numCases = images.shape[0]
+        else:
+            numCases = cases.shape[0]
+        starts = range(0, numCases, self.batchSize)
+        numThreads = min(self.numThreads, len(starts))
+
+        def work(t):
+            ## Thread t does batches t, t + numThreads, ...
+            engine = self.engines[t]
+            numErrors = 0
+            crossEntropy = 0.
+            for start in starts[t::numThreads]:
+                stop = min(start + self.batchSize, numCases)
+                numcases = stop - start
+                if cases is None:
+                    inputData = images[start:stop]
+                    batchLabels = labels[start:stop]
+                else:
+                    which = cases[start:stop]
+                    inputData = self.gather(t, images, which)
+                    batchLabels = labels[which]
+
+                targets = self.targets[t][:numcases]
+                targets.fill(0)
+                targets[self.caseIndex[:numcases], batchLabels] = 1
+                crossEntropy += engine.crossEntropy(inputData, targets)
+
+                classes = engine.classBuffer[:numcases]
+                np.argmax(engine.probabilities(numcases), axis=1, out=classes)
+                numErrors += numcases - np.count_nonzero(classes == batchLabels)
+            return numErrors, crossEntropy
+
+        if numThreads > 1:
+            results = self.pool.map(work, range(numThreads))
+        else:
+            results = [ work(0) ]
+        numErrors = sum([ e for (e, f) in results ])
+        crossEntropy = sum([ f for (e, f) in results ])
+        record('eval', cases=numCases, errors=numErrors, crossEntropy=float(crossEntropy),
+               seconds=time.time() - tStart)
+        return numErrors, crossEntropy, numCases
+
+    def gather(self, t, images, which):
+        ## Copy the chosen cases into thread t's buffer (in their raw
+        ## dtype; the engine scales them).
+        if images.dtype not in self.rawBuffers[t]:
+            self.rawBuffers[t][images.dtype] = np.empty((self.batchSize, images.shape[1]),
+                                                        images.dtype)
+        raw = self.rawBuffers[t][images.dtype][:which.shape[0]]
+        np.take(images, which, axis=0, out=raw)
+        return raw
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+import numpy as np
+from scipy.special import expit
+
+from softmaxUtils import softmax, softmaxCrossEntropy
+
+
+## LogisticHinton2006.recognize() allocates new matrices for every step
+## of every layer (the product, the negation, the exp, the 1+, the
+## reciprocal...).  That is fine for training, but when we only want to
+## score lots of batches, this class does the same computation in
+## buffers that are allocated once, up front, for batches of up to
+## maxBatchSize cases.  Once it is built, scoring allocates nothing.
+##
+## The weights are read from the network on every call, so an engine
+## stays valid while the network is trained.  Each engine has its own
+## buffers, so use one engine per thread.
+
+class InferenceEngine:
+    def __init__(self, nn, maxBatchSize):
+        self.nn = nn
+        self.dtype = nn.dtype
+        self.maxBatchSize = maxBatchSize
+
+        numvis = nn.W[0].shape[0]
+        self.inputBuffer = np.empty((maxBatchSize, numvis), self.dtype)
+        self.layerOut = [ np.empty((maxBatchSize, W.shape[1]), self.dtype)
+                          for W in nn.W ]
+        self.rowBuffer = np.empty((maxBatchSize, 1), self.dtype)
+        self.classBuffer = np.empty(maxBatchSize, np.intp)
+
+    def prepareInput(self, inputData):
+        ## Inputs of the right dtype are used as they are.  Anything else
+        ## is converted into the input buffer (uint8 pixels are scaled to
+        ## [0, 1], like datasetUtils.scaleBatch does).
+        if inputData.dtype == self.dtype:
+            return inputData
+        numcases = inputData.shape[0]
+        x = self.inputBuffer[:numcases]
+        np.copyto(x, inputData, casting='unsafe')
+        if inputData.dtype == np.uint8:
+            x /= 255.
+        return x
+
+    def logits(self, inputData):
+        ## The inputs to the final softmax, as a view of this engine's
+        ## buffer.  It is overwritten by the next call, so copy it if it
+        ## needs to be kept.
+        numcases = inputData.shape[0]
+        assert numcases <= self.maxBatchSize, "Batch is bigger than maxBatchSize."
+        nn = self.nn
+
+        x = self.prepareInput(inputData)
+        for layer in range(3):
+            out = self.layerOut[layer][:numcases]
+            np.dot(x, nn.W[layer], out=out)
+            out += nn.hB[layer]
+            expit(out, out=out)
+            x = out
+
+        out = self.layerOut[3][:numcases]
+        np.dot(x, nn.W[3], out=out)
+        out += nn.hB[3]
+        return out
+
+    def recognize(self, inputData):
+        ## The class probabilities (also a view of a buffer).
+        return softmax(self.logits(inputData), self.rowBuffer)
+
+    def crossEntropy(self, inputData, targets):
+        ## The summed cross-entropy error.  Afterwards, the class
+        ## probabilities are in self.probabilities(numcases).
+        return softmaxCrossEntropy(self.logits(inputData), targets,
+                                   gradient=False, rowBuffer=self.rowBuffer)
+
+    def probabilities(self, numcases):
+        return self.layerOut[3][:numcases]
+
+    def classify(self, inputData):
+        ## The most likely class of each case (also a view of a buffer).
+        probs = self.recognize(inputData)
+        classes = self.classBuffer[:probs.shape[0]]
+        np.argmax(probs, axis=1, out=classes)
+        return classes
@@ -22,15 +22,29 @@
 
 import time, sys, os
 import numpy as np
-import scipy.io as sio
 
 from flattenUtils import *
+from checkpointUtils import saveArrays, loadArrays, isCheckpoint
+from softmaxUtils import softmax
+from randomStreams import uniform
 import minimize as cg
-from backprop import backprop, backprop_only3
+from backprop import backprop, backprop_only3, backpropFlops
+from telemetry import record, gflops
 
 
 class LogisticHinton2006:
-    def __init__(self):
+    def __init__(self, dtype=np.float64):
+        ## All of the weights, biases and activations are kept in this
+        ## dtype.  np.float32 halves the memory use, and BLAS does about
+        ## twice as many single-precision multiply-adds per second.
+        self.dtype = np.dtype(dtype)
+
+        ## Cached outputs of layer 2, keyed by batch (see layer2Features).
+        ## They are only valid for one version of the lower layers
+        ## (0, 1 and 2), so the version is bumped whenever those change.
+        self.lowerLayersVersion = 0
+        self.featureCache = {}
+
         ## The "up" methods are for bottom-up recognition.
         self.up = [self.up0, self.up1, self.up2, self.up3]
         ## The "down" methods are for top-down generation.  (ie, asking the 
@@ -63,23 +77,94 @@ class LogisticHinton2006:
         ##                                 the neurons ABOVE are HIDDEN.  
         ##  So Layer2's hidden neurons are the same as Layer3's visible neurons.  
 
-    def initRBM(self):
-        self.W = [ 0.1*np.random.randn(784, 500),
-                   0.1*np.random.randn(500, 500),
-                   0.1*np.random.randn(500, 2000),
-                   0.1*np.random.randn(2000, 10)    ]
-
-        self.hB = [ np.zeros((1,500)),
-                    np.zeros((1,500)),
-                    np.zeros((1,2000)),
-                    np.zeros((1,10))    ]
-
-        self.vB = [ np.zeros((1,784)),
-                    np.zeros((1,500)),
-                    np.zeros((1,500)),
-                    np.zeros((1,2000))  ]
+    def initRBM(self, layerSizes=[784, 500, 500, 2000, 10]):
+        self.allocateParameters(layerSizes)
+        for i in range(4):
+            self.W[i][...] = 0.1*np.random.randn(*self.W[i].shape)
+
+    def allocateParameters(self, layerSizes, parameters=None):
+        ## All of the parameters live in one contiguous 1-D array,
+        ## self.parameters, and W, hB and vB are views into it.  So
+        ## minimize() and backprop() can work on the parameters directly,
+        ## with no flattening or un-flattening.  (This also means that
+        ## W, hB and vB must be changed in place, never re-assigned.)
+        ##
+        ## The parameters that are fine-tuned come first, in the order
+        ##    W0, hB0, W1, hB1, W2, hB2, W3, hB3
+        ## (see self.Dim), which ends with the layer-3 parameters.  The
+        ## visible biases, only used in pretraining, come last.
+        self.layerSizes = [ int(n) for n in layerSizes ]
+        self.Dim = []
+        for i in range(4):
+            self.Dim.append((self.layerSizes[i], self.layerSizes[i+1]))
+            self.Dim.append((1, self.layerSizes[i+1]))
+        vBDim = [ (1, self.layerSizes[i]) for i in range(4) ]
+
+        numParameters = multiSize(self.Dim + vBDim)
+        if parameters is None:
+            parameters = np.zeros(numParameters, self.dtype)
+        assert parameters.shape == (numParameters,)
+        assert parameters.dtype == self.dtype
+        self.parameters = parameters
+        self.fineTuneEnd = multiSize(self.Dim)
+        self.layer3Start = multiSize(self.Dim[:6])
+
+        matrices = multiView(self.parameters, self.Dim + vBDim)
+        self.W  = matrices[0:8:2]
+        self.hB = matrices[1:8:2]
+        self.vB = matrices[8:12]
+        self.lowerLayersChanged()
+
+    def setParameters(self, W, hB, vB):
+        ## Copy parameters (of any dtype) into a new parameter array.
+        layerSizes = [ W[0].shape[0] ] + [ x.shape[1] for x in W ]
+        self.allocateParameters(layerSizes)
+        for i in range(4):
+            self.W[i][...]  = W[i]
+            self.hB[i][...] = hB[i]
+            self.vB[i][...] = vB[i]
+
+    def lowerLayersChanged(self):
+        ## Call this whenever W, hB or vB of layers 0, 1 or 2 change.
+        self.lowerLayersVersion += 1
+        self.featureCache = {}
+
+    def layer2Features(self, inputData, key=None):
+        ## recognize012(), but remembered under 'key' until the lower
+        ## layers change.  With key=None, nothing is cached.
+        if key is None:
+            return self.recognize012(inputData)
+        if key not in self.featureCache:
+            self.featureCache[key] = self.recognize012(inputData)
+        return self.featureCache[key]
+
+    ## Checkpoints are saved in our own format (see checkpointUtils.py),
+    ## which is memory-mapped when it is loaded.  The default mmapMode,
+    ## 'c', is copy-on-write:  the weights are shared with the file (and
+    ## with any other process that loaded it) until they are changed.
+    ## Use mmapMode='r' for inference-only processes.
+    ## Matlab .mat files can still be written and read, with saveMat()
+    ## and loadMat(), or with convertCheckpoint.py.
 
     def save(self, filename):
+        saveArrays(filename, ['layerSizes', 'parameters'],
+                   [np.array(self.layerSizes), self.parameters])
+
+    def load(self, filename, mmapMode='c'):
+        if not isCheckpoint(filename):
+            return self.loadMat(filename)
+        myDict = loadArrays(filename, mmapMode)
+        if 'parameters' not in myDict:
+            # Older checkpoints hold each matrix separately:
+            return self.setParameters([ myDict['W%d'  % i] for i in range(4) ],
+                                      [ myDict['hB%d' % i] for i in range(4) ],
+                                      [ myDict['vB%d' % i] for i in range(4) ])
+        # The parameters are only copied if they have a different dtype:
+        parameters = np.asarray(myDict['parameters'], dtype=self.dtype)
+        self.allocateParameters(myDict['layerSizes'], parameters)
+
+    def saveMat(self, filename):
+        import scipy.io as sio
         return sio.savemat(filename, {'W0': self.W[0], 
                                       'W1': self.W[1],
                                       'W2': self.W[2],
@@ -93,23 +178,25 @@ class LogisticHinton2006:
                                       'vB2': self.vB[2],
                                       'vB3': self.vB[3] }, oned_as='row')
 
-    def load(self, filename):
+    def loadMat(self, filename):
+        import scipy.io as sio
         myDict = sio.loadmat(filename, struct_as_record=True)
-        self.W = []
-        self.hB = []
-        self.vB = []
-        self.W.append(myDict['W0'])
-        self.W.append(myDict['W1'])
-        self.W.append(myDict['W2'])
-        self.W.append(myDict['W3'])
-        self.hB.append(myDict['hB0'])
-        self.hB.append(myDict['hB1'])
-        self.hB.append(myDict['hB2'])
-        self.hB.append(myDict['hB3'])
-        self.vB.append(myDict['vB0'])
-        self.vB.append(myDict['vB1'])
-        self.vB.append(myDict['vB2'])
-        self.vB.append(myDict['vB3'])
+        W = []
+        hB = []
+        vB = []
+        W.append(myDict['W0'])
+        W.append(myDict['W1'])
+        W.append(myDict['W2'])
+        W.append(myDict['W3'])
+        hB.append(myDict['hB0'])
+        hB.append(myDict['hB1'])
+        hB.append(myDict['hB2'])
+        hB.append(myDict['hB3'])
+        vB.append(myDict['vB0'])
+        vB.append(myDict['vB1'])
+        vB.append(myDict['vB2'])
+        vB.append(myDict['vB3'])
+        self.setParameters(W, hB, vB)
 
     def recognize(self, inputData):
         return self.up3(self.up2(self.up1(self.up0(inputData))))
@@ -130,7 +217,14 @@ class LogisticHinton2006:
         return 1./(1. + np.exp(-np.dot(inputData, self.W[2]) - self.hB[2]))
 
     def up3(self, inputData):
-        return np.exp( np.dot(inputData, self.W[3]) + self.hB[3])
+        ## The class probabilities.  (See logits3 for their logarithms,
+        ## up to a constant.)
+        return softmax(self.logits3(inputData))
+
+    def logits3(self, inputData):
+        logits = np.dot(inputData, self.W[3])
+        logits += self.hB[3]
+        return logits
 
     def down0(self, inputData):
         return 1./(1. + np.exp(-np.dot(inputData, self.W[0].T) - self.vB[0]))
@@ -145,48 +239,67 @@ class LogisticHinton2006:
         return 1./(1. + np.exp(-np.dot(inputData, self.W[3].T) - self.vB[3]))
 
 
-    def minimizeLayer3(self, inputData, targets, max_iter):
-        layer2out = self.recognize012(inputData)
-
-        #### Flatten all of our parameters into a 1-D array
-        (VV, Dim) = multiFlatten(( self.W[3], self.hB[3] ))
-
-        (X, fX, iters) = cg.minimize(VV, backprop_only3, (Dim, layer2out, targets), max_iter)
-
-        #### Un-Flatten all of our parameters from the 1-D array
-        matrices = multiUnFlatten(X, Dim)
-        self.W[3]  = matrices[0]
-        self.hB[3] = matrices[1]
-
-
-    def minimizeAllLayers(self, inputData, targets, max_iter):
-        #### Flatten all of our parameters into a 1-D array
-        (VV, Dim) = multiFlatten((  self.W[0], self.hB[0],
-                                    self.W[1], self.hB[1],
-                                    self.W[2], self.hB[2],
-                                    self.W[3], self.hB[3]  ))
-
-        (X, fX, iters) = cg.minimize(VV, backprop, (Dim, inputData, targets), max_iter)
-
-        #### Un-Flatten all of our parameters from the 1-D array
-        matrices = multiUnFlatten(X, Dim)
-        self.W[0]  = matrices[0]
-        self.hB[0] = matrices[1]
-        self.W[1]  = matrices[2]
-        self.hB[1] = matrices[3]
-        self.W[2]  = matrices[4]
-        self.hB[2] = matrices[5]
-        self.W[3]  = matrices[6]
-        self.hB[3] = matrices[7]
+    ## The optimizer can be minimize.minimize (conjugate gradients, the
+    ## default) or lbfgs.lbfgs, or anything else with the same arguments
+    ## that updates VV in place.  The gradient can be backprop_only3 or
+    ## backprop (the defaults), or a ChunkedGradient that wraps them.
+
+    ## Only layer 3 changes here, so layer 2's output can be given
+    ## directly (layer2out), or cached between calls (cacheKey, see
+    ## layer2Features).
+    def minimizeLayer3(self, inputData, targets, max_iter, layer2out=None, cacheKey=None,
+                       optimizer=cg.minimize, gradient=backprop_only3):
+        if layer2out is None:
+            layer2out = self.layer2Features(inputData, cacheKey)
+
+        #### Our parameters are already in a 1-D array (W3 and hB3 are
+        #### at its end), so minimize() can use them directly:
+        VV = self.parameters[self.layer3Start:self.fineTuneEnd]
+
+        ## (The optimizer updates VV in place.)
+        self.optimize('3', optimizer, VV, gradient, (self.Dim[6:8], layer2out, targets), max_iter)
+
+
+    def minimizeAllLayers(self, inputData, targets, max_iter, optimizer=cg.minimize,
+                          gradient=backprop):
+        #### Our parameters are already in a 1-D array:
+        VV = self.parameters[:self.fineTuneEnd]
+
+        ## (The optimizer updates VV in place.)
+        self.optimize('all', optimizer, VV, gradient, (self.Dim, inputData, targets), max_iter)
+        self.lowerLayersChanged()
+
+    def optimize(self, layers, optimizer, VV, gradient, args, max_iter):
+        ## Runs the optimizer, and reports the batch to telemetry, as a
+        ## 'finetune.batch' record.  The gradient's evaluations are
+        ## counted and timed here, so that any optimizer will do.
+        counts = {'evaluations': 0, 'seconds': 0.}
+        def countedGradient(*fArgs, **fKwargs):
+            tStart = time.time()
+            result = gradient(*fArgs, **fKwargs)
+            counts['seconds'] += time.time() - tStart
+            counts['evaluations'] += 1
+            return result
+
+        tStart = time.time()
+        (X, fX, iters) = optimizer(VV, countedGradient, args, max_iter)
+        (Dim, inputs) = args[:2]
+        numcases = inputs.shape[0]
+        flops = counts['evaluations'] * backpropFlops(Dim, numcases)
+        record('finetune.batch', layers=layers, cases=numcases,
+               evaluations=counts['evaluations'], linesearches=iters,
+               value=(float(fX[-1]) if fX else None), seconds=time.time() - tStart,
+               gflops=gflops(flops, counts['seconds']))
 
 
     # 1-step Constrastive Divergence:
-    def cd1(self, whichLayer, inputData, randomNumbers = None):
+    def cd1(self, whichLayer, inputData, randomNumbers = None, rng = None):
 
-        #  randomNumbers
-        # We can use pre-defined "random" numbers so that repeat runs
-        # will produce identical results.  The default is to create our own
-        # random numbers on the fly. 
+        #  randomNumbers, rng
+        # We can use pre-defined "random" numbers, or a seeded random
+        # stream (see randomStreams.py), so that repeat runs will produce
+        # identical results.  The default is to create our own random
+        # numbers on the fly (from numpy's global random state).
 
         epsilonW = 0.1
         epsilonVB = 0.1
@@ -201,9 +314,12 @@ class LogisticHinton2006:
 
         #### Positive Phase:
         poshidprobs = up(inputData)
-        if (randomNumbers == None):
-            randomNumbers = np.random.rand(poshidprobs.shape[0], poshidprobs.shape[1])
-        poshidstates = 1 * (poshidprobs > randomNumbers)
+        if randomNumbers is None:
+            if rng is None:
+                randomNumbers = np.random.rand(poshidprobs.shape[0], poshidprobs.shape[1])
+            else:
+                randomNumbers = uniform(rng, poshidprobs.shape, self.dtype)
+        poshidstates = (poshidprobs > randomNumbers).astype(self.dtype)
         del randomNumbers
         posprods = np.dot(inputData.T, poshidprobs)  #an unbiased sample, <v_i, h_j>_data
 
@@ -21,50 +21,58 @@
 
 import numpy as np
 from flattenUtils import *
+from softmaxUtils import softmaxCrossEntropy
 
 
-def backprop_only3(VV, Dim, inputs, targets):
+## The floating-point operations in the matrix products of one
+## backprop() (or backprop_only3(), with its Dim) on numcases cases:
+## the forward pass, the weights' gradients, and the errors passed down
+## to every layer but the first.
+def backpropFlops(Dim, numcases):
+    sizes = [ numvis * numhid for (numvis, numhid) in Dim[0::2] ]
+    return 2. * numcases * (3 * sum(sizes) - sizes[0])
 
-    #### Un-Flatten all of our parameters from the 1-D array
-    matrices = multiUnFlatten(VV, Dim)
-    W = matrices[0]
-    hB = matrices[1]
 
-    ## This is the last layer of the neural network, in bottom-up, 
-    ## "recognition" mode:
-    nnTargetOut = np.exp(np.dot(inputs, W) + hB)
-
-    # Normalize our outputs into probability distributions:
-    nnTargetOut = nnTargetOut / np.tile(nnTargetOut.sum(1)[:, np.newaxis], (1,10) )
+def backprop_only3(VV, Dim, inputs, targets, df=None):
 
-    # We use cross-entropy rather than squared error for our error function:
-    f = -(targets * np.log(nnTargetOut)).sum(0).sum(0)
+    #### View our parameters in the 1-D array (no copies are made)
+    (W, hB) = multiView(VV, Dim)
 
-    classError = nnTargetOut - targets
-
-    ## Flatten the gradients into the same shape as VV:
-    (df, Dim2) = multiFlatten((   np.dot(inputs.T, classError), 
-                                  classError.sum(0)[np.newaxis, :]  ))
-    assert Dim2 == Dim
+    ## This is the last layer of the neural network, in bottom-up, 
+    ## "recognition" mode:
+    classError = np.dot(inputs, W)
+    classError += hB
+
+    # We use cross-entropy rather than squared error for our error function.
+    # (This normalizes our outputs into probability distributions, and
+    # leaves the classification error in classError.)
+    f = softmaxCrossEntropy(classError, targets)
+
+    ## The gradients are written straight into a 1-D array shaped like VV
+    ## (df, if it is given, so that callers can reuse one array):
+    if df is None:
+        df = np.empty_like(VV)
+    (deltaW, deltaHB) = multiView(df, Dim)
+    np.dot(inputs.T, classError, out=deltaW)
+    np.sum(classError, axis=0, out=deltaHB[0])
 
     return (f, df)
 
 
 
-def backprop(VV, Dim, inputs, targets):
-    W = [0]*4  #synaptic weight matrix
-    hB = [0]*4  #hidden biases
+def backprop(VV, Dim, inputs, targets, df=None):
+    #### View our parameters in the 1-D array (no copies are made)
+    matrices = multiView(VV, Dim)
+    W = matrices[0::2]  #synaptic weight matrix
+    hB = matrices[1::2]  #hidden biases
 
-    #### Un-Flatten all of our parameters from the 1-D array
-    matrices = multiUnFlatten(VV, Dim)
-    W[0]  = matrices[0]
-    hB[0] = matrices[1]
-    W[1]  = matrices[2]
-    hB[1] = matrices[3]
-    W[2]  = matrices[4]
-    hB[2] = matrices[5]
-    W[3]  = matrices[6]
-    hB[3] = matrices[7]
+    ## The gradients are written straight into a 1-D array shaped like VV
+    ## (df, if it is given, so that callers can reuse one array):
+    if df is None:
+        df = np.empty_like(VV)
+    deltas = multiView(df, Dim)
+    deltaW = deltas[0::2]
+    deltaHB = deltas[1::2]
 
     # Logistic activation function:
     actF = lambda x: 1./(1. + np.exp(-x))
@@ -73,45 +81,33 @@ def backprop(VV, Dim, inputs, targets):
     layer0out = actF(   np.dot(inputs,    W[0]) + hB[0]) #numpy auto-tiles hB
     layer1out = actF(   np.dot(layer0out, W[1]) + hB[1]) #numpy auto-tiles hB
     layer2out = actF(   np.dot(layer1out, W[2]) + hB[2]) #numpy auto-tiles hB
-    layer3out = np.exp( np.dot(layer2out, W[3]) + hB[3]) #numpy auto-tiles hB
-
-    targetout = layer3out
-
-    # Normalize our outputs into probability distributions:
-    targetout = targetout / np.tile( targetout.sum(1)[:, np.newaxis], (1,10) )
-
-    # We use cross-entropy rather than squared error for our error function:
-    f = -(targets * np.log(targetout)).sum(0).sum(0)
+    Ix_class = np.dot(layer2out, W[3])
+    Ix_class += hB[3]                                    #numpy auto-tiles hB
 
-    # Classification error:
-    Ix_class = targetout - targets
+    # We use cross-entropy rather than squared error for our error function.
+    # (This normalizes our outputs into probability distributions, and
+    # leaves the classification error in Ix_class.)
+    f = softmaxCrossEntropy(Ix_class, targets)
 
     # propagate the error back down the neural network ("backprop"):
-    deltaW3 = np.dot(layer2out.conj().T, Ix_class)
-    deltaHB3 = Ix_class.sum(0)[np.newaxis, :]
+    np.dot(layer2out.T, Ix_class, out=deltaW[3])
+    np.sum(Ix_class, axis=0, out=deltaHB[3][0])
 
     ## For backprop, we take the derivative actF acting on the
     ## input data.  
     ## For the Logistic function, the derivative of actF(x) 
     ## is actF(x) * (1 - actF(x))
     Ix3 = np.dot(Ix_class, W[3].T) * layer2out * (1-layer2out)
-    deltaW2 = np.dot(layer1out.T, Ix3)
-    deltaHB2 = Ix3.sum(0)[np.newaxis, :]
+    np.dot(layer1out.T, Ix3, out=deltaW[2])
+    np.sum(Ix3, axis=0, out=deltaHB[2][0])
 
     Ix2 = np.dot(Ix3, W[2].T) * layer1out * (1-layer1out)
-    deltaW1 = np.dot(layer0out.T, Ix2)
-    deltaHB1 = Ix2.sum(0)[np.newaxis, :]
+    np.dot(layer0out.T, Ix2, out=deltaW[1])
+    np.sum(Ix2, axis=0, out=deltaHB[1][0])
 
     Ix1 = np.dot(Ix2, W[1].T) * layer0out * (1-layer0out)
-    deltaW0 = np.dot(inputs.T, Ix1)
-    deltaHB0 = Ix1.sum(0)[np.newaxis, :]
-
-    ## Flatten the gradients into the same shape as VV:
-    (df, Dim2) = multiFlatten(( deltaW0, deltaHB0, 
-                                deltaW1, deltaHB1, 
-                                deltaW2, deltaHB2, 
-                                deltaW3, deltaHB3 ))
-    assert Dim2 == Dim
+    np.dot(inputs.T, Ix1, out=deltaW[0])
+    np.sum(Ix1, axis=0, out=deltaHB[0][0])
 
     return (f, df)
 
@@ -20,81 +20,140 @@
 
 
 
-import sys
 import time
 import numpy as np
-import scipy.io as sio
 
-def batchCD1(nn, whichLayer, allInputData, maxepoch=10, baseFileName=""):
-    numCases = allInputData.shape[0]
-    assert numCases == 60000, "Expecting 60,000 inputs."
-    # We will divide the data into 600 batches:
-    numbatches = 600
-    batchsize = 100
-    assert batchsize * numbatches == numCases
+from datasetUtils import dataSource, prefetch
+from randomStreams import batchStream
+from CDSampler import CDSampler
+from telemetry import record, gflops
+
+## allInputData can be an array (or memmap), or anything else that
+## datasetUtils.dataSource() accepts.  The cases are taken in batches of
+## 'batchsize' (the last one may be smaller), in a new random order every
+## epoch if shuffle is set.
+##
+## With a seed, the run is reproducible:  the random numbers for each
+## batch (and the order of each epoch) come from their own stream (see
+## randomStreams.py), and randomState isn't used.  Without one, they
+## come from randomState and numpy's global random state.
+##
+## Each batch takes k steps of Gibbs sampling (CD-k), and with
+## persistent=True, the negative phase continues the chains left by the
+## previous batch (Persistent CD).  See CDSampler.py.
+##
+## With prefetchBatches, each batch is prepared on a background thread
+## while the one before it is being trained on (see datasetUtils.prefetch).
+## (Without a seed, that makes the shuffling take its turn with numpy's
+## global random state at a different time, so runs differ.)
+##
+## To resume a run, give startEpoch (the first epoch still to do) and
+## the sampler that was used (with its momentum and chains), and
+## epochDone(epoch, sampler) is called at the end of every epoch, eg to
+## save a checkpoint (see train.py).
+##
+## Progress goes to telemetry (see telemetry.py):  a 'cd.batch' record
+## for every batch, and a 'cd.epoch' record for every epoch.
+##
+## Returns the hidden probabilities of every case, from the last epoch
+## (the input data for the next layer up).  That is numCases x numhid
+## values, so there are two ways to avoid keeping it in memory:
+##   hidProbsFile     - write it to this (.npy) file, which is memory-
+##                      mapped, and return the memmap.
+##   keepHidProbs=False - don't keep it at all, and return None.  (The
+##                      next layer can recompute it from this one, a
+##                      batch at a time, with datasetUtils.RecognitionSource.)
+
+def batchCD1(nn, whichLayer, allInputData, maxepoch=10, seed=None,
+             batchsize=100, shuffle=False, randomState=np.random,
+             keepHidProbs=True, hidProbsFile=None, k=1, persistent=False,
+             prefetchBatches=False, startEpoch=0, sampler=None, epochDone=None):
+    source = dataSource(allInputData, nn.dtype)
+    if sampler is None:
+        sampler = CDSampler(nn, whichLayer, batchsize, k, persistent)
 
     (numvis, numhid) = nn.W[whichLayer].shape
 
     print "Pretraining Layer %d.  %d visible units, %d hidden units." % (whichLayer, numvis, numhid)
 
-    deltaW = np.zeros(nn.W[whichLayer].shape) # Synaptic weight matrix
-    deltaHB = np.zeros(nn.hB[whichLayer].shape) # Hidden biases
-    deltaVB = np.zeros(nn.vB[whichLayer].shape) # Visible biases
-    batchHidProbs = np.zeros((numCases, numhid))
+    knownSize = source.numCases is not None
+    if hidProbsFile and not knownSize:
+        raise Exception("hidProbsFile needs a data source of known size.")
+    if keepHidProbs and hidProbsFile:
+        batchHidProbs = np.lib.format.open_memmap(hidProbsFile, mode='w+', dtype=nn.dtype,
+                                                  shape=(source.numCases, numhid))
+    elif keepHidProbs and knownSize:
+        batchHidProbs = np.zeros((source.numCases, numhid), nn.dtype)
+    elif keepHidProbs:
+        ## We don't know how many cases there are, so the last epoch's
+        ## hidden probabilities are collected a batch at a time.
+        hidProbsList = []
+
+    if knownSize:
+        numbatches = -(-source.numCases // batchsize)
+        print "Doing %d epochs * %d batches of (up to) %d cases." % (maxepoch, numbatches, batchsize)
+    else:
+        print "Doing %d epochs, in batches of (up to) %d cases." % (maxepoch, batchsize)
 
     initialmomentum = 0.5
     finalmomentum = 0.9
 
-    print "Doing %d epochs * %d batches." % (maxepoch, numbatches)
-    for epoch in xrange(maxepoch):
+    for epoch in xrange(startEpoch, maxepoch):
         tStart = time.time()
         print "epoch ", epoch
-        if baseFileName:
-            randCompare = sio.loadmat('%s-randCompare%d.mat' % (baseFileName, epoch+1), 
-                                      struct_as_record=True)['randCompare']
+        if seed is not None:
+            randomState = batchStream(seed, whichLayer, epoch)
 
         errsum = 0.
-        for batch in xrange(numbatches):
-            sys.stdout.write("epoch %d batch %d\r" % (epoch, batch))
-            sys.stdout.flush()
-            start = batch * batchsize
-            stop = (batch+1) * batchsize
-
-            inputData = allInputData[start:stop, :]
-            try:
-                batchRandCompare = randCompare[batch, :, :]
-            except:
-                batchRandCompare = None
-
-            (lDeltaW, lDeltaVB, lDeltaHB, poshidprobs, err) = nn.cd1(whichLayer, inputData, batchRandCompare)
-            del batchRandCompare
-
-            batchHidProbs[start:stop, :] = poshidprobs
+        lastEpoch = (epoch == maxepoch - 1)
+        batch = 0
+        if prefetchBatches:
+            batches = prefetch(source.batches(batchsize, shuffle, randomState, numBuffers=2), 2)
+        else:
+            batches = source.batches(batchsize, shuffle, randomState)
+        for (where, inputData) in batches:
+            if seed is not None:
+                rng = batchStream(seed, whichLayer, epoch, batch)
+            else:
+                rng = None
 
-            errsum += err
             if (epoch > 4):
                 momentum = finalmomentum
             else:
                 momentum = initialmomentum
 
-            deltaW  = momentum * deltaW  + lDeltaW
-            deltaVB = momentum * deltaVB + lDeltaVB
-            deltaHB = momentum * deltaHB + lDeltaHB
-
-            nn.W[whichLayer]  = nn.W[whichLayer]  + deltaW
-            nn.vB[whichLayer] = nn.vB[whichLayer] + deltaVB
-            nn.hB[whichLayer] = nn.hB[whichLayer] + deltaHB
+            ## (The sampler keeps the momentum-smoothed changes to the
+            ## weights and biases, and applies them in place.)
+            tBatch = time.time()
+            (poshidprobs, err) = sampler.train(inputData, momentum, rng)
+            seconds = time.time() - tBatch
+            numcases = inputData.shape[0]
+            record('cd.batch', layer=whichLayer, epoch=epoch, batch=batch, cases=numcases,
+                   seconds=seconds, gflops=gflops(sampler.flops(numcases), seconds),
+                   error=float(err))
+            if whichLayer < 3:
+                nn.lowerLayersChanged()
+
+            if lastEpoch and keepHidProbs:
+                if knownSize:
+                    batchHidProbs[where] = poshidprobs
+                else:
+                    hidProbsList.append(poshidprobs.copy())
 
-        try:
-            del randCompare # can be huge memory consumption
-        except:
-            pass
-
-        print "\nepoch %d error %6.1f" % (epoch, errsum)
+            errsum += err
+            batch += 1
 
         tEnd = time.time()
+        record('cd.epoch', layer=whichLayer, epoch=epoch, seconds=tEnd-tStart, error=float(errsum))
+        print "epoch %d error %6.1f" % (epoch, errsum)
         print "total time: %.3f seconds\n" % (tEnd-tStart)
-
+        if epochDone is not None:
+            epochDone(epoch, sampler)
+
+    if not keepHidProbs:
+        return None
+    if not knownSize:
+        return np.concatenate(hidProbsList)
+    if hidProbsFile:
+        batchHidProbs.flush()
     return batchHidProbs
-
-
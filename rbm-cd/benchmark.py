@@ -0,0 +1,282 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+## Benchmarks of the hot paths, on synthetic data with the real layer
+## shapes (784-500-500-2000-10), so they need no downloaded dataset.
+## Each kernel is timed at several batch sizes and dtypes:
+##
+##    cd1.layer<n>            nn.cd1() on layer n
+##    CDSampler.layer<n>      CDSampler.train() on layer n (what batchCD1 uses)
+##    backprop                backprop() through all four layers
+##    backprop_only3          backprop_only3() on layer 2's output
+##    recognize               nn.recognize()
+##    InferenceEngine         InferenceEngine.crossEntropy()
+##    minimize                minimize() with 3 line searches, all layers
+##
+## and, end to end, one pretraining epoch of layer 0 (batchCD1) and one
+## fine-tuning epoch of all the layers (3 line searches per batch of
+## 1000, as in step 2), on --cases cases.
+##
+## Every kernel is run once to warm up, and then --repeats times.  The
+## epochs are timed the same way, each run starting from a new network,
+## but --epoch-repeats times (1 by default, as they are long).  The
+## results are written as JSON (to --output, or to stdout, in which case
+## anything the training code prints goes to stderr), with the numpy
+## version, BLAS, machine and git commit, so that runs can be compared
+## across commits and BLAS builds:
+##
+##    {"meta": {...},
+##     "results": [{"name": "backprop", "dtype": "float64", "batchsize": 100,
+##                  "repeats": 5, "best": ..., "median": ..., "mean": ...,
+##                  "gflops": ...}, ...]}
+##
+## The times are in seconds, and gflops is for the best time (for the
+## matrix products only).  For example:
+##    python benchmark.py --output before.json
+##    python benchmark.py --dtypes float32 --batch-sizes 100 --no-epochs
+
+import os
+import sys
+import time
+import platform
+import subprocess
+from optparse import OptionParser
+import json
+import numpy as np
+
+import NeuralNetwork
+import telemetry
+import minimize as cg
+from backprop import backprop, backprop_only3, backpropFlops
+from batchCD1 import batchCD1
+from CDSampler import CDSampler
+from InferenceEngine import InferenceEngine
+from datasetUtils import scaleBatch, oneHot, BatchLoader
+
+LAYER_SIZES = [784, 500, 500, 2000, 10]
+
+
+def parseOptions(args):
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--output', default=None,
+                      help="write the JSON results to this file (default:  stdout)")
+    parser.add_option('--dtypes', default='float64,float32', help="[%default]")
+    parser.add_option('--batch-sizes', default='10,100,1000', dest='batchSizes',
+                      help="[%default]")
+    parser.add_option('--repeats', type='int', default=5, help="[%default]")
+    parser.add_option('--kernels', default=None,
+                      help="only the kernels whose names start with one of these")
+    parser.add_option('--no-epochs', action='store_false', default=True, dest='epochs',
+                      help="skip the end-to-end epochs")
+    parser.add_option('--cases', type='int', default=60000,
+                      help="cases in the end-to-end epochs [%default]")
+    parser.add_option('--epoch-repeats', type='int', default=1, dest='epochRepeats',
+                      help="timed runs of each epoch, after the warm-up [%default]")
+    parser.add_option('--seed', type='int', default=0, help="[%default]")
+    (options, args) = parser.parse_args(args)
+    if args:
+        parser.error("unexpected arguments:  %s" % ' '.join(args))
+    options.dtypes = [ np.dtype(name) for name in options.dtypes.split(',') ]
+    options.batchSizes = [ int(size) for size in options.batchSizes.split(',') ]
+    if options.kernels:
+        options.kernels = options.kernels.split(',')
+    return options
+
+
+def syntheticData(numCases, randomState):
+    ## MNIST-like:  uint8 images, about 20% of the pixels on (and some
+    ## grey), and integer labels.
+    images = randomState.randint(0, 256, (numCases, LAYER_SIZES[0]))
+    images[images < 205] = 0
+    images = images.astype(np.uint8)
+    labels = randomState.randint(0, LAYER_SIZES[-1], numCases)
+    return images, labels
+
+
+def makeNetwork(dtype, seed):
+    nn = NeuralNetwork.LogisticHinton2006(dtype)
+    np.random.seed(seed)
+    nn.initRBM(LAYER_SIZES)
+    nn.vB[3][...] = 0.1*np.random.randn(*nn.vB[3].shape)
+    nn.hB[3][...] = 0.1*np.random.randn(*nn.hB[3].shape)
+    return nn
+
+
+def timeIt(run, repeats, setup=None):
+    ## Returns the times of 'repeats' runs, after one to warm up.  setup()
+    ## is called (untimed) before each run.
+    times = []
+    for r in range(repeats + 1):
+        if setup is not None:
+            setup()
+        tStart = time.time()
+        run()
+        seconds = time.time() - tStart
+        if r > 0:
+            times.append(seconds)
+    return times
+
+
+def result(name, dtype, batchsize, times, flops=None, **extra):
+    best = min(times)
+    entry = dict(name=name, dtype=np.dtype(dtype).name, batchsize=batchsize,
+                 repeats=len(times), best=best, median=float(np.median(times)),
+                 mean=float(np.mean(times)),
+                 gflops=(telemetry.gflops(flops, best) if flops else None))
+    entry.update(extra)
+    return entry
+
+
+def kernelResults(options):
+    randomState = np.random.RandomState(options.seed)
+    maxBatchSize = max(options.batchSizes)
+    (images, labels) = syntheticData(maxBatchSize, randomState)
+    results = []
+
+    def wanted(name):
+        if not options.kernels:
+            return True
+        return any([ name.startswith(prefix) for prefix in options.kernels ])
+
+    for dtype in options.dtypes:
+        nn = makeNetwork(dtype, options.seed)
+        for batchsize in options.batchSizes:
+            data = scaleBatch(images[:batchsize], dtype)
+            targets = oneHot(labels[:batchsize], LAYER_SIZES[-1], dtype)
+            layerInputs = [data]
+            for layer in range(3):
+                layerInputs.append(nn.up[layer](layerInputs[-1]))
+            repeats = options.repeats
+
+            for layer in range(3):
+                inputData = layerInputs[layer]
+                sampler = CDSampler(nn, layer, batchsize)
+                flops = sampler.flops(batchsize)
+                name = 'cd1.layer%d' % layer
+                if wanted(name):
+                    times = timeIt(lambda: nn.cd1(layer, inputData), repeats)
+                    results.append(result(name, dtype, batchsize, times, flops))
+                name = 'CDSampler.layer%d' % layer
+                if wanted(name):
+                    ## (This trains the weights, which doesn't change the speed.)
+                    times = timeIt(lambda: sampler.train(inputData, 0.5), repeats)
+                    results.append(result(name, dtype, batchsize, times, flops))
+
+            VV = nn.parameters[:nn.fineTuneEnd]
+            if wanted('backprop_only3'):
+                VV3 = nn.parameters[nn.layer3Start:nn.fineTuneEnd]
+                df = np.empty_like(VV3)
+                times = timeIt(lambda: backprop_only3(VV3, nn.Dim[6:8], layerInputs[3],
+                                                      targets, df), repeats)
+                results.append(result('backprop_only3', dtype, batchsize, times,
+                                      backpropFlops(nn.Dim[6:8], batchsize)))
+            if wanted('backprop'):
+                df = np.empty_like(VV)
+                times = timeIt(lambda: backprop(VV, nn.Dim, data, targets, df), repeats)
+                results.append(result('backprop', dtype, batchsize, times,
+                                      backpropFlops(nn.Dim, batchsize)))
+
+            forwardFlops = 2. * batchsize * sum([ a * b for (a, b) in nn.Dim[0::2] ])
+            if wanted('recognize'):
+                times = timeIt(lambda: nn.recognize(data), repeats)
+                results.append(result('recognize', dtype, batchsize, times, forwardFlops))
+            if wanted('InferenceEngine'):
+                engine = InferenceEngine(nn, batchsize)
+                times = timeIt(lambda: engine.crossEntropy(data, targets), repeats)
+                results.append(result('InferenceEngine', dtype, batchsize, times, forwardFlops))
+
+            if wanted('minimize'):
+                ## Each run starts from the same weights.  (The number of
+                ## backprop() calls varies, so gflops is left out.)
+                start = VV.copy()
+                stats = {}
+                def reset():
+                    VV[...] = start
+                times = timeIt(lambda: cg.minimize(VV, backprop, (nn.Dim, data, targets), 3,
+                                                   verbose=False, stats=stats),
+                               repeats, reset)
+                reset()
+                results.append(result('minimize', dtype, batchsize, times,
+                                      evaluations=stats['funevals']))
+    return results
+
+
+def epochResults(options):
+    randomState = np.random.RandomState(options.seed)
+    (images, labels) = syntheticData(options.cases, randomState)
+    results = []
+    repeats = options.epochRepeats
+    for dtype in options.dtypes:
+        ## Every run starts from the same new network (made untimed):
+        networks = []
+        def newNetwork():
+            networks[:] = [makeNetwork(dtype, options.seed)]
+
+        def pretrainEpoch():
+            batchCD1(networks[0], 0, images, maxepoch=1, seed=options.seed, batchsize=100,
+                     shuffle=True, keepHidProbs=False, prefetchBatches=True)
+        times = timeIt(pretrainEpoch, repeats, newNetwork)
+        results.append(result('pretrainEpoch.layer0', dtype, 100, times,
+                              cases=options.cases))
+
+        loader = BatchLoader(images, labels, 1000, LAYER_SIZES[-1], dtype)
+        def fineTuneEpoch():
+            for batch in xrange(loader.numbatches):
+                (data, targets) = loader.getBatch(batch)
+                networks[0].minimizeAllLayers(data, targets, 3)
+        times = timeIt(fineTuneEpoch, repeats, newNetwork)
+        results.append(result('fineTuneEpoch', dtype, 1000, times,
+                              cases=loader.numbatches * 1000))
+    return results
+
+
+def metadata(options):
+    try:
+        commit = subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))
+                                  ).communicate()[0].strip() or None
+    except OSError:
+        commit = None
+    try:
+        blas = np.__config__.get_info('blas_opt_info')
+    except Exception:
+        blas = None
+    return dict(date=time.strftime('%Y-%m-%dT%H:%M:%S'), commit=commit,
+                python=platform.python_version(), numpy=np.__version__,
+                blas=blas, platform=platform.platform(), machine=platform.machine(),
+                processor=platform.processor(), cpus=os.sysconf('SC_NPROCESSORS_ONLN'),
+                options=dict(dtypes=[ dtype.name for dtype in options.dtypes ],
+                             batchSizes=options.batchSizes, repeats=options.repeats,
+                             epochRepeats=options.epochRepeats, cases=options.cases,
+                             seed=options.seed))
+
+
+def main(args):
+    options = parseOptions(args)
+    ## Keep stdout for the JSON, and the progress reports out of the timings:
+    stdout = sys.stdout
+    if options.output is None:
+        sys.stdout = sys.stderr
+    telemetry.setSinks(telemetry.NullSink())
+    try:
+        results = kernelResults(options)
+        if options.epochs:
+            results += epochResults(options)
+    finally:
+        sys.stdout = stdout
+
+    report = dict(meta=metadata(options), results=results)
+    if options.output is None:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print
+    else:
+        f = open(options.output, 'w')
+        json.dump(report, f, indent=1, sort_keys=True)
+        f.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+import os
+import ast
+import struct
+import numpy as np
+
+
+### A simple, versioned file format for a named set of numpy arrays.
+### Unlike a .mat file, it can be memory-mapped:  loading costs no
+### parsing or copying, and any number of processes that load the same
+### file read-only share a single copy of it in the OS page cache.
+###
+### The layout is:
+###    8 bytes     magic string 'ERUDITIO'
+###    uint32      format version
+###    uint32      header length, in bytes
+###    header      an ASCII Python literal:
+###                  [(name, dtype, shape, offset), ...]
+###                (offset is counted from the start of the data)
+###    padding     up to a multiple of ALIGN bytes
+###    data        each array in C order, each starting on a
+###                multiple of ALIGN bytes
+
+MAGIC = 'ERUDITIO'
+VERSION = 1
+ALIGN = 64
+
+
+def alignUp(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def saveArrays(fileName, names, arrays):
+    entries = []
+    offset = 0
+    for (name, array) in zip(names, arrays):
+        entries.append((name, array.dtype.str, tuple(array.shape), offset))
+        offset = alignUp(offset + array.nbytes)
+    header = repr(entries)
+    dataStart = alignUp(len(MAGIC) + 8 + len(header))
+
+    ## Written to a temporary file, which then replaces the old one:  a
+    ## network loaded (memory-mapped) from fileName keeps reading the old
+    ## file, so it can be saved back to the same name.
+    temporaryFile = fileName + '.tmp'
+    f = open(temporaryFile, 'wb')
+    f.write(MAGIC)
+    f.write(struct.pack('<II', VERSION, len(header)))
+    f.write(header)
+    for ((name, dtype, shape, offset), array) in zip(entries, arrays):
+        f.write('\0' * (dataStart + offset - f.tell()))
+        np.ascontiguousarray(array).tofile(f)
+    f.close()
+    os.rename(temporaryFile, fileName)
+
+
+def isCheckpoint(fileName):
+    f = open(fileName, 'rb')
+    magic = f.read(len(MAGIC))
+    f.close()
+    return magic == MAGIC
+
+
+def loadArrays(fileName, mmapMode='r'):
+    ## mmapMode is as for np.memmap:
+    ##    'r'  read-only, shared between processes
+    ##    'c'  copy-on-write:  pages are shared until they are written to
+    ##    'r+' writes go back to the file
+    f = open(fileName, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        raise Exception("%s is not a checkpoint file." % fileName)
+    (version, headerLength) = struct.unpack('<II', f.read(8))
+    if version != VERSION:
+        raise Exception("%s has checkpoint version %d; expected %d." % (fileName, version, VERSION))
+    entries = ast.literal_eval(f.read(headerLength))
+    f.close()
+    dataStart = alignUp(len(MAGIC) + 8 + headerLength)
+
+    fileMap = np.memmap(fileName, dtype='uint8', mode=mmapMode)
+    arrays = {}
+    for (name, dtype, shape, offset) in entries:
+        count = int(np.prod(shape))
+        array = np.frombuffer(fileMap, dtype=dtype, count=count,
+                              offset=dataStart + offset)
+        arrays[name] = array.reshape(shape)
+    return arrays
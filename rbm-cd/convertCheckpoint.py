@@ -0,0 +1,33 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+# Convert a saved neural network between our own checkpoint format
+# (see checkpointUtils.py) and a Matlab .mat file.  The direction is
+# chosen by the output file's extension:
+#
+#    python convertCheckpoint.py nnData/NN_afterPreTrain.nn nnData/NN_afterPreTrain.mat
+#    python convertCheckpoint.py nnData/NN_afterPreTrain.mat nnData/NN_afterPreTrain.nn
+
+import sys
+
+import NeuralNetwork
+
+
+def usageAndExit():
+    sys.stderr.write('Usage:  ' + sys.argv[0] + ' inFile outFile\n')
+    sys.exit(1)
+
+
+if len(sys.argv) != 3:
+    usageAndExit()
+
+(inFileName, outFileName) = sys.argv[1:]
+
+nn = NeuralNetwork.LogisticHinton2006()
+nn.load(inFileName, mmapMode='r')
+
+if outFileName.endswith('.mat'):
+    nn.saveMat(outFileName)
+else:
+    nn.save(outFileName)
@@ -0,0 +1,281 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+import os
+import sys
+import threading
+import Queue
+import numpy as np
+import scipy.io as sio
+
+
+### The datasets are stored compactly:  the images as uint8 pixels
+### (0..255) and the targets as integer class labels.  Turning pixels
+### into floats (scaled to 1.0) and labels into one-hot target vectors
+### is only done one batch at a time, when the batch is taken, so the
+### full dataset never sits in memory as float64.
+
+def loadDataset(baseName):
+    ## The preferred format is a pair of .npy files, which we memory-map
+    ## read-only:  opening them is instant, pages are only read when a
+    ## batch touches them, and concurrent runs share the OS page cache.
+    if baseName.endswith('.mat'):
+        baseName = baseName[:-len('.mat')]
+    imagesFile = baseName + '-images.npy'
+    labelsFile = baseName + '-labels.npy'
+    if os.path.exists(imagesFile) and os.path.exists(labelsFile):
+        images = np.load(imagesFile, mmap_mode='r')
+        labels = np.load(labelsFile, mmap_mode='r')
+        return images, labels
+
+    ## Otherwise, fall back to the (slower) .mat file:
+    data = sio.loadmat(baseName + '.mat', struct_as_record=True)
+    images = data['images']
+    if 'labels' in data:
+        labels = data['labels'].ravel()
+    else:
+        # Older files have float images and one-hot targets:
+        labels = data['targets'].argmax(1)
+    return images, labels
+
+
+def numClassesOf(labels):
+    return int(labels.max()) + 1
+
+
+def scaleBatch(rawBatch, dtype=np.float64):
+    ## uint8 pixels are scaled to [0, 1].  Anything else (eg, the
+    ## hidden probabilities of a lower layer) is already scaled.
+    if rawBatch.dtype == np.uint8:
+        batch = rawBatch.astype(dtype)
+        batch /= 255.
+        return batch
+    return np.asarray(rawBatch, dtype=dtype)
+
+
+def oneHot(labels, numClasses, dtype=np.float64):
+    targets = np.zeros((labels.shape[0], numClasses), dtype=dtype)
+    targets[np.arange(labels.shape[0]), labels] = 1
+    return targets
+
+
+class BatchLoader:
+    def __init__(self, images, labels=None, batchsize=100, numClasses=None,
+                 dtype=np.float64):
+        self.images = images
+        self.labels = labels
+        self.batchsize = batchsize
+        self.dtype = dtype
+        if labels is not None:
+            assert labels.shape[0] == images.shape[0]
+            if numClasses is None:
+                numClasses = numClassesOf(labels)
+        self.numClasses = numClasses
+
+        self.numCases = images.shape[0]
+        self.numbatches = self.numCases / batchsize
+
+    def bounds(self, batch):
+        start = batch * self.batchsize
+        stop = (batch+1) * self.batchsize
+        return start, stop
+
+    def getImages(self, batch):
+        (start, stop) = self.bounds(batch)
+        return scaleBatch(self.images[start:stop, :], self.dtype)
+
+    def getTargets(self, batch):
+        (start, stop) = self.bounds(batch)
+        return oneHot(self.labels[start:stop], self.numClasses, self.dtype)
+
+    def getBatch(self, batch):
+        return self.getImages(batch), self.getTargets(batch)
+
+
+### Data sources, for pretraining (see batchCD1).  A source hands out
+### its cases in batches of any size.  Each batch is gathered (and
+### scaled) into one preallocated buffer, so the batch it gives is only
+### valid until the next one is taken.  The last batch is smaller if
+### batchsize doesn't divide the number of cases.
+###
+### Along with each batch comes 'where', the indices of its cases in
+### the whole dataset:  a slice, or an array of indices if shuffled.
+###
+### With numBuffers > 1, a source takes turns between that many
+### buffers, so that a batch stays valid until numBuffers-1 more have
+### been taken (see prefetch, below).
+
+class ArraySource:
+    ## For arrays, including memory-mapped ones (eg, from loadDataset).
+    def __init__(self, data, dtype=np.float64):
+        self.data = data
+        self.dtype = dtype
+        self.numCases = data.shape[0]
+        self.numDims = data.shape[1]
+
+    def batches(self, batchsize, shuffle=False, randomState=np.random,
+                order=None, first=0, step=1, numBuffers=1):
+        ## With shuffle, the cases are visited in a new random order
+        ## every time this is called (ie, every epoch).  Or the order can
+        ## be given (a permutation of the cases).  With first and step,
+        ## only every step'th batch is taken, starting with batch number
+        ## 'first', so that several workers can share an epoch.
+        data = self.data
+        buffers = [ np.empty((batchsize, self.numDims), self.dtype)
+                    for i in range(numBuffers) ]
+        if data.dtype != self.dtype:
+            rawBuffer = np.empty((batchsize, self.numDims), data.dtype)
+        if shuffle and order is None:
+            order = randomState.permutation(self.numCases)
+
+        for (i, start) in enumerate(xrange(first * batchsize, self.numCases, step * batchsize)):
+            stop = min(start + batchsize, self.numCases)
+            batch = buffers[i % numBuffers][:stop-start]
+            if order is not None:
+                ## (The order within a batch doesn't matter, and in
+                ## order, a memmap reads its pages sequentially.)
+                where = np.sort(order[start:stop])
+                if data.dtype == self.dtype:
+                    np.take(data, where, axis=0, out=batch)
+                else:
+                    raw = rawBuffer[:stop-start]
+                    np.take(data, where, axis=0, out=raw)
+                    np.copyto(batch, raw, casting='unsafe')
+            else:
+                where = slice(start, stop)
+                np.copyto(batch, data[where], casting='unsafe')
+            if data.dtype == np.uint8:
+                batch /= 255.
+            yield where, batch
+
+
+class GeneratorSource:
+    ## For data that isn't in one array (eg, read or generated a piece
+    ## at a time).  makeChunks() must return a new iterator over 2-D
+    ## arrays of cases (rows) each time it is called, ie, every epoch.
+    ## The cases are taken in the order they come, so shuffle is
+    ## ignored:  makeChunks() should shuffle the chunks, if it can.
+    ## numCases is only known after the first pass.
+    def __init__(self, makeChunks, dtype=np.float64):
+        self.makeChunks = makeChunks
+        self.dtype = dtype
+        self.numCases = None
+
+    def batches(self, batchsize, shuffle=False, randomState=np.random, numBuffers=1):
+        buffers = None
+        start = 0
+        filled = 0
+        for chunk in self.makeChunks():
+            if buffers is None:
+                buffers = [ np.empty((batchsize, chunk.shape[1]), self.dtype)
+                            for i in range(numBuffers) ]
+                buffer = buffers[0]
+            pos = 0
+            while pos < chunk.shape[0]:
+                count = min(batchsize - filled, chunk.shape[0] - pos)
+                part = buffer[filled:filled+count]
+                np.copyto(part, chunk[pos:pos+count], casting='unsafe')
+                if chunk.dtype == np.uint8:
+                    part /= 255.
+                pos += count
+                filled += count
+                if filled == batchsize:
+                    yield slice(start, start + filled), buffer
+                    start += filled
+                    filled = 0
+                    buffer = buffers[(start // batchsize) % numBuffers]
+        if filled > 0:
+            yield slice(start, start + filled), buffer[:filled]
+            start += filled
+        self.numCases = start
+
+
+class RecognitionSource:
+    ## The output of the network's layers 0 .. numLayers-1 for another
+    ## source's cases, computed a batch at a time, so that the output
+    ## for the whole dataset is never in memory at once.  (It is
+    ## recomputed every epoch:  computation traded for memory.)
+    def __init__(self, nn, numLayers, data):
+        self.nn = nn
+        self.numLayers = numLayers
+        self.source = dataSource(data, nn.dtype)
+        self.dtype = nn.dtype
+        self.numCases = self.source.numCases
+        self.numDims = nn.W[numLayers-1].shape[1]
+
+    def batches(self, batchsize, shuffle=False, randomState=np.random, numBuffers=1):
+        ## (The outputs are new arrays, but the inputs' buffers take turns.)
+        for (where, batch) in self.source.batches(batchsize, shuffle, randomState,
+                                                  numBuffers=numBuffers):
+            for layer in range(self.numLayers):
+                batch = self.nn.up[layer](batch)
+            yield where, batch
+        self.numCases = self.source.numCases
+
+
+def dataSource(data, dtype=np.float64):
+    ## Wrap data (a source, an array or memmap, or a function that
+    ## returns an iterator over chunks) in a data source.
+    if hasattr(data, 'batches'):
+        return data
+    if isinstance(data, np.ndarray):
+        return ArraySource(data, dtype)
+    if callable(data):
+        return GeneratorSource(data, dtype)
+    raise Exception("Expecting an array, or a function that returns an iterator "
+                    "over chunks of cases (an iterator can only be read once).")
+
+
+### Preparing a batch (gathering it, converting it to floats, and
+### waiting for a memmap to read it from disk) doesn't need to hold up
+### the training.  prefetch() runs any iterator (eg, a source's
+### batches, with numBuffers=2) on a background thread, so that the next
+### item is being prepared while the current one is used.  numpy lets
+### go of the GIL while it copies and converts arrays, so the two
+### overlap.
+###
+### The background thread is never more than numBuffers-1 items ahead:
+### it only goes on to the next item once the one numBuffers before it
+### has been finished with (ie, once the item after it was asked for).
+### So an iterator that takes turns between numBuffers buffers never
+### overwrites a batch that is still in use.
+
+def prefetch(iterator, numBuffers=2):
+    free = threading.Semaphore(numBuffers)
+    ready = Queue.Queue()
+    finished = []                  # (set when the consumer stops early)
+    end = object()
+
+    def produce():
+        try:
+            while True:
+                free.acquire()
+                if finished:
+                    break
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    break
+                ready.put((item, None))
+        except Exception:
+            ready.put((None, sys.exc_info()))
+        ready.put((end, None))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            (item, error) = ready.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            if item is end:
+                break
+            yield item
+            free.release()              # (we are done with that item)
+    finally:
+        finished.append(True)
+        free.release()
+        thread.join()
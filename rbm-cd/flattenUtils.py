@@ -30,3 +30,22 @@ def multiUnFlatten(VV, Dim):
 
 
 
+
+
+### Better still is to never flatten anything:  keep all of the
+### parameters in one contiguous 1-D array, and use views of it as the
+### matrices.  (These views are in C order, unlike multiUnFlatten.)
+
+def multiSize(Dim):
+    return sum([ int(np.prod(shape)) for shape in Dim ])
+
+
+def multiView(VV, Dim):
+    VV = VV.reshape(-1)
+    matrices = []
+    start = 0
+    for shape in Dim:
+        stop = start + int(np.prod(shape))
+        matrices.append(VV[start:stop].reshape(shape))
+        start = stop
+    return matrices
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+"""lbfgs.py
+
+This module contains a function 'lbfgs' that performs unconstrained
+gradient based optimization using the limited-memory BFGS method
+(Nocedal and Wright, "Numerical Optimization", algorithms 7.4 and 7.5).
+
+It is a drop-in alternative to minimize.minimize:  it takes the same
+(X, f, args, maxnumlinesearch, maxnumfuneval) arguments, expects f to
+return the same (f, df) pair, updates X in place, and returns the same
+(X, fX, i).  It keeps the last 'm' steps and gradient changes in
+preallocated arrays, and runs the two-loop recursion in place, so it
+allocates nothing per iteration.
+
+"""
+
+
+import time
+import numpy as np
+from numpy import dot, isinf, isnan, any, sqrt, inf
+from telemetry import record
+
+
+def lbfgs(X, f, args, maxnumlinesearch=None, maxnumfuneval=None, m=10,
+          red=1.0, verbose=True, stats=None):
+    C1 = 1e-4                 # sufficient decrease constant, 0 < C1 < C2 < 1
+    C2 = 0.9                                     # curvature (slope) constant
+    EXT = 3.0              # extrapolate maximum 3 times the current step-size
+    MAX = 20                      # max 20 function evaluations per line search
+    SMALL = 1e-10        # curvature (y's) below which a pair isn't remembered
+
+    if maxnumlinesearch == None:
+        if maxnumfuneval == None:
+            raise Exception("Specify maxnumlinesearch or maxnumfuneval")
+        else:
+            S = 'Function evaluation'
+    else:
+        if maxnumfuneval != None:
+            raise Exception("Specify either maxnumlinesearch or maxnumfuneval (not both)")
+        else:
+            S = 'Linesearch'
+
+    #### Work vectors, allocated once:
+    n = X.shape[0]
+    steps = np.empty((m, n), X.dtype)                 # s_k = x_{k+1} - x_k
+    gradChanges = np.empty((m, n), X.dtype)           # y_k = g_{k+1} - g_k
+    rho = np.zeros(m)                                 # 1 / (y_k' s_k)
+    alpha = np.zeros(m)
+    numPairs = 0                              # how many pairs are remembered
+    newest = -1                                # where the newest pair is kept
+    g = np.empty_like(X)                                  # gradient at X
+    gTrial = np.empty_like(X)                             # gradient at Xtrial
+    d = np.empty_like(X)                                  # search direction
+    Xtrial = np.empty_like(X)
+    tmp = np.empty_like(X)
+    counts = {'funevals': 0, 'linesearches': 0, 'ftime': 0.}
+
+    def evaluate(x):
+        tStart = time.time()
+        (fx, dfx) = f(x, *args)
+        counts['ftime'] += time.time() - tStart
+        counts['funevals'] += 1
+        return fx, dfx
+
+    def outOfTime():
+        if maxnumfuneval != None:
+            return counts['funevals'] >= maxnumfuneval
+        return i >= maxnumlinesearch
+
+    (f0, df0) = evaluate(X)
+    g[...] = df0
+    fX = [f0]
+    i = 0
+    ls_failed = 0
+
+    while not outOfTime():
+        #### Two-loop recursion:  d = -H g, in place.
+        d[...] = g
+        for k in range(numPairs):                         # newest to oldest
+            j = (newest - k) % m
+            alpha[j] = rho[j] * dot(steps[j], d)
+            np.multiply(gradChanges[j], alpha[j], out=tmp); d -= tmp
+        if numPairs > 0:
+            ## Scale by the curvature of the newest pair:
+            d *= 1. / (rho[newest] * dot(gradChanges[newest], gradChanges[newest]))
+        for k in reversed(range(numPairs)):               # oldest to newest
+            j = (newest - k) % m
+            beta = rho[j] * dot(gradChanges[j], d)
+            np.multiply(steps[j], alpha[j] - beta, out=tmp); d += tmp
+        np.negative(d, out=d)
+
+        d0 = dot(g, d)                                    # slope along d
+        if d0 >= 0:           # not a descent direction, so forget the history
+            np.negative(g, out=d); d0 = -dot(g, g)
+            numPairs = 0; newest = -1
+        if numPairs > 0:
+            t = 1.0                         # quasi-Newton steps are unit steps
+        else:
+            t = red / (1.0 + sqrt(dot(g, g)))   # first step is red/(|g|+1)
+
+        #### Line search for a step t that satisfies the (weak) Wolfe
+        #### conditions:  enough decrease (C1), and a slope that has
+        #### flattened out enough (C2).  A step that decreases f enough
+        #### but is still steep is too short, so we extrapolate; a step
+        #### that doesn't decrease f enough is too long, so we bisect.
+        i = i + 1; counts['linesearches'] += 1
+        success = 0
+        tLow = 0.; tHigh = inf                       # the step is in between
+        fLow = f0                      # f at the best (sufficient) step so far
+        for M in range(MAX):
+            if maxnumfuneval != None and counts['funevals'] >= maxnumfuneval:
+                break
+            np.multiply(d, t, out=Xtrial); Xtrial += X
+            (f3, df3) = evaluate(Xtrial)
+            if isnan(f3) or isinf(f3) or any(isnan(df3)+isinf(df3)) or \
+               f3 > f0 + C1 * t * d0:
+                tHigh = t                                      # too long
+            elif dot(df3, d) < C2 * d0:
+                tLow = t; fLow = f3                          # too short
+                gTrial[...] = df3             # (f may reuse its own buffer)
+            else:
+                gTrial[...] = df3
+                success = 1
+                break
+            if tHigh == inf:
+                t = EXT * t                                 # extrapolate
+            else:
+                t = 0.5 * (tLow + tHigh)                          # bisect
+        if not success and tLow > 0:
+            ## We ran out of evaluations, but we did find a step with
+            ## enough decrease, so take that one:
+            t = tLow; f3 = fLow
+            np.multiply(d, t, out=Xtrial); Xtrial += X
+            success = 1
+
+        if success:
+            np.subtract(Xtrial, X, out=tmp)                      # the step
+            np.subtract(gTrial, g, out=d)         # the change in the gradient
+            ys = dot(d, tmp)
+            if ys > SMALL:                              # remember the pair
+                newest = (newest + 1) % m
+                steps[newest] = tmp; gradChanges[newest] = d
+                rho[newest] = 1. / ys
+                numPairs = min(numPairs + 1, m)
+            X[...] = Xtrial; g[...] = gTrial; f0 = f3; fX.append(f0)
+            if verbose: record('minimize.linesearch', method='lbfgs', iteration=i, value=float(f0))
+            ls_failed = 0
+        else:
+            if ls_failed or outOfTime():  # line search failed twice in a row
+                break                    # or we ran out of time, so we give up
+            numPairs = 0; newest = -1           # try steepest descent again
+            ls_failed = 1
+
+    if stats is not None:
+        stats.update(counts)
+    if verbose:
+        record('minimize.done', method='lbfgs', evaluations=counts['funevals'],
+               linesearches=counts['linesearches'], fseconds=counts['ftime'])
+    return X, fX, i
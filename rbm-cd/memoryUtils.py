@@ -0,0 +1,223 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+import os
+import sys
+import time
+import resource
+import threading
+import numpy as np
+
+from telemetry import record
+
+
+### How much memory training takes, and how to make it fit.
+###
+### MemoryTracker measures the process's resident memory in named
+### phases (eg, each pretraining layer, each fine-tuning epoch):  at
+### the start and end of each, and its peak, from a background thread
+### that samples it every 'interval' seconds (and from getrusage's
+### peak, which catches what falls between the samples, when it is a
+### new peak for the process).
+###
+###    tracker = MemoryTracker()
+###    tracker.start('layer0')
+###    ...
+###    tracker.stop()          # also a 'memory.phase' telemetry record
+###    tracker.report()
+###
+### planMemory() picks the settings that decide the big allocations,
+### so that a run fits in a given number of bytes:
+###
+###    layerOutputs       - keep each layer's output (numCases x numhid)
+###                         in 'memory', or 'spill' it to a memory-mapped
+###                         file (step 1)
+###    featureCache       - cache layer 2's output for the layer-3-only
+###                         epochs of fine-tuning (numCases x 2000)
+###    gradientChunkSize  - backprop in chunks (see ChunkedGradient.py),
+###                         or None for the whole batch at once
+###    evalBatchSize      - the Evaluator's batch size
+###
+### It estimates the memory of each choice from the shapes, takes the
+### fastest settings, and gives them up, one at a time, until the
+### estimate fits.  The learning batch sizes (100 for pretraining and
+### 1000 for fine-tuning) change the training itself, so they are left
+### alone.  The estimates are rough (numpy's temporaries are counted
+### generously), so leave some room.
+
+def currentRSS():
+    ## Resident memory in bytes, or None where /proc isn't available.
+    try:
+        f = open('/proc/self/statm')
+        pages = int(f.read().split()[1])
+        f.close()
+    except (IOError, OSError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def peakRSS():
+    ## The process's peak resident memory so far, in bytes.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak                              # (already in bytes)
+    return peak * 1024
+
+
+def parseBytes(text):
+    ## '4G', '512M', '100k' or a plain number of bytes.
+    units = {'k': 2**10, 'm': 2**20, 'g': 2**30, 't': 2**40}
+    text = text.strip().lower().rstrip('b')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def formatBytes(n):
+    if n is None:
+        return '?'
+    for (unit, size) in (('G', 2**30), ('M', 2**20), ('k', 2**10)):
+        if n >= size:
+            return '%.1f%s' % (float(n) / size, unit)
+    return '%d' % n
+
+
+class MemoryTracker:
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.phases = []       # (name, startBytes, peakBytes, endBytes, seconds)
+        self.current = None
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.sample)
+        thread.daemon = True
+        thread.start()
+
+    def sample(self):
+        while True:
+            rss = currentRSS()
+            if rss is None:
+                return                        # (only getrusage, then)
+            self.lock.acquire()
+            if self.current is not None and rss > self.current['peak']:
+                self.current['peak'] = rss
+            self.lock.release()
+            time.sleep(self.interval)
+
+    def start(self, name):
+        if self.current is not None:
+            self.stop()
+        rss = currentRSS()
+        self.lock.acquire()
+        self.current = dict(name=name, start=rss, peak=rss or 0,
+                            processPeak=peakRSS(), time=time.time())
+        self.lock.release()
+
+    def stop(self):
+        rss = currentRSS()
+        processPeak = peakRSS()
+        self.lock.acquire()
+        phase = self.current
+        self.current = None
+        self.lock.release()
+        peak = max(phase['peak'], rss or 0)
+        if processPeak > phase['processPeak']:
+            peak = max(peak, processPeak)     # (a new peak, so it was in this phase)
+        seconds = time.time() - phase['time']
+        self.phases.append((phase['name'], phase['start'], peak, rss, seconds))
+        record('memory.phase', phase=phase['name'], startBytes=phase['start'],
+               peakBytes=peak, endBytes=rss, seconds=seconds)
+
+    def report(self):
+        print "Memory (resident):     start      peak       end"
+        for (name, start, peak, end, seconds) in self.phases:
+            print "  %-18s %9s %9s %9s" % (name, formatBytes(start), formatBytes(peak),
+                                           formatBytes(end))
+        print "  Peak for the process:  %s" % formatBytes(peakRSS())
+
+
+def planMemory(budget, numCases, layerSizes=[784, 500, 500, 2000, 10], dtype=np.float64,
+               pretrainBatchSize=100, fineTuneBatchSize=1000, evalThreads=1, baseline=None,
+               layerOutputs=None):
+    ## Returns a dictionary of the settings (as above), with the estimated
+    ## bytes for pretraining and fine-tuning, and whether they fit the
+    ## budget ('fits').  baseline is the memory already in use (by the
+    ## interpreter, numpy, ...); by default, what is resident now.
+    ## evalThreads must be the Evaluator's number of threads (each has
+    ## its own buffers).  Give layerOutputs if it is already decided
+    ## (eg, 'spill' in train.py).
+    s = np.dtype(dtype).itemsize
+    if baseline is None:
+        baseline = currentRSS() or 0
+    numParameters = sum([ layerSizes[i] * layerSizes[i+1] + layerSizes[i+1] + layerSizes[i]
+                          for i in range(4) ])
+    fineTuneParameters = sum([ layerSizes[i] * layerSizes[i+1] + layerSizes[i+1]
+                               for i in range(4) ])
+    widths = sum(layerSizes)
+    ## The uint8 images (memory-mapped, but resident once they are read):
+    fixed = baseline + numParameters * s + numCases * layerSizes[0]
+
+    def pretrainBytes(layerOutputs):
+        b = pretrainBatchSize
+        peak = 0
+        for layer in range(3):
+            (v, h) = layerSizes[layer:layer+2]
+            ## CDSampler's buffers (deltaW, negProds, velocityW, and the
+            ## batch-sized ones) and two prefetched input batches:
+            layerBytes = s * (3 * v * h + b * (5 * h + 4 * v)) + 8 * b * h
+            if layerOutputs == 'memory':
+                ## This layer's input and output, both held:
+                layerBytes += numCases * h * s
+                if layer > 0:
+                    layerBytes += numCases * v * s
+            peak = max(peak, layerBytes)
+        return fixed + peak
+
+    def fineTuneBytes(featureCache, gradientChunkSize, evalBatchSize):
+        B = fineTuneBatchSize
+        c = min(gradientChunkSize or B, B)
+        ## The optimizer's work vectors (minimize() keeps 5) and the
+        ## gradient, and a ChunkedGradient's sums:
+        optimizer = 6 * fineTuneParameters * s
+        if gradientChunkSize:
+            optimizer += 2 * fineTuneParameters * s
+        ## backprop()'s activations, their temporaries and the deltas:
+        activations = 3 * c * widths * s
+        batches = 2 * B * (layerSizes[0] + layerSizes[-1]) * s
+        cache = numCases * layerSizes[3] * s if featureCache else 0
+        evaluation = evalThreads * evalBatchSize * (widths + layerSizes[0]) * s * 2
+        return fixed + optimizer + activations + batches + cache + evaluation
+
+    plan = dict(layerOutputs=(layerOutputs or 'memory'), featureCache=True,
+                gradientChunkSize=None, evalBatchSize=1000)
+    if layerOutputs is None and pretrainBytes('memory') > budget:
+        plan['layerOutputs'] = 'spill'
+
+    def fineTuneEstimate():
+        return fineTuneBytes(plan['featureCache'], plan['gradientChunkSize'],
+                             plan['evalBatchSize'])
+    ## What to give up, in turn:
+    steps = [('featureCache', False)]
+    for size in (500, 250, 100):
+        steps += [('gradientChunkSize', size), ('evalBatchSize', size)]
+    for (setting, value) in steps:
+        if fineTuneEstimate() <= budget:
+            break
+        plan[setting] = value
+
+    plan['pretrainBytes'] = pretrainBytes(plan['layerOutputs'])
+    plan['fineTuneBytes'] = fineTuneEstimate()
+    plan['fits'] = max(plan['pretrainBytes'], plan['fineTuneBytes']) <= budget
+    return plan
+
+
+def printPlan(plan, budget):
+    print "Memory budget %s:  pretraining needs about %s, fine-tuning about %s." % (
+        formatBytes(budget), formatBytes(plan['pretrainBytes']),
+        formatBytes(plan['fineTuneBytes']))
+    print "  layerOutputs=%r featureCache=%r gradientChunkSize=%r evalBatchSize=%r" % (
+        plan['layerOutputs'], plan['featureCache'], plan['gradientChunkSize'],
+        plan['evalBatchSize'])
+    if not plan['fits']:
+        print "  WARNING:  even so, this probably doesn't fit in the budget."
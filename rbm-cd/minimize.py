@@ -36,12 +36,23 @@ gradient based optimization using nonlinear conjugate gradients.
 The function is a straightforward Python-translation of Carl Rasmussen's
 Matlab-function minimize.m
 
+Changes from minimize.m:  X is updated in place (and also returned).
+All work vectors are allocated once and updated in place, a point that
+is evaluated twice reuses the first result, and the number of function
+evaluations and line searches is counted (stored in the dict 'stats',
+if one is given).  When verbose, progress goes to telemetry (see
+telemetry.py) instead of being printed:  a 'minimize.linesearch' record
+for every line search, and a 'minimize.done' record at the end.
+
 """
 
 
+import time
 from numpy import dot, isinf, isnan, any, sqrt, isreal, real, nan, inf
+from numpy import empty_like, multiply, negative, add
+from telemetry import record
 
-def minimize(X, f, args, maxnumlinesearch=None, maxnumfuneval=None, red=1.0, verbose=True):
+def minimize(X, f, args, maxnumlinesearch=None, maxnumfuneval=None, red=1.0, verbose=True, stats=None):
     INT = 0.1;# don't reevaluate within 0.1 of the limit of the current bracket
     EXT = 3.0;              # extrapolate maximum 3 times the current step-size
     MAX = 20;                     # max 20 function evaluations per line search
@@ -70,18 +81,58 @@ def minimize(X, f, args, maxnumlinesearch=None, maxnumfuneval=None, red=1.0, ver
             S = 'Linesearch'
             length = maxnumlinesearch
 
+    #### Work vectors, allocated once.  Every point we evaluate is on the
+    #### current line, X + x3*s, and is built in Xtrial.  The gradients
+    #### we keep (df0, dF0, df3) are references to three buffers, so
+    #### "copying" one is just re-pointing a name.
+    Xtrial = empty_like(X)
+    s = empty_like(X)
+    dfBuffers = [empty_like(X), empty_like(X), empty_like(X)]
+    df0 = dF0 = None
+    counts = {'funevals': 0, 'cachehits': 0, 'linesearches': 0, 'ftime': 0.}
+    cache = {'line': None, 'x3': None}
+    line = [0]
+
+    def freeBuffer():                # a gradient buffer that nothing is using
+        for buf in dfBuffers:
+            if buf is not df0 and buf is not dF0:
+                return buf
+
+    def evaluate(x3):             # f and its gradient at X + x3*s, memoized
+        if cache['line'] == line[0] and cache['x3'] == x3:
+            counts['cachehits'] += 1
+            return cache['f'], cache['df']
+        multiply(s, x3, out=Xtrial); add(Xtrial, X, out=Xtrial)
+        tStart = time.time()
+        (fx, dfx) = f(Xtrial, *args)
+        counts['ftime'] += time.time() - tStart
+        counts['funevals'] += 1
+        buf = freeBuffer(); buf[...] = dfx    # (f may reuse its own buffer)
+        cache.update(line=line[0], x3=x3, f=fx, df=buf)
+        return fx, buf
+
+    def takeStep(x3):                                      # X = X + x3*s
+        if x3 != 0:
+            multiply(s, x3, out=Xtrial); add(X, Xtrial, out=X)
+
     i = 0                                         # zero the run length counter
     ls_failed = 0                          # no previous line search has failed
-    (f0, df0) = f(X, *args)                          # get function value and gradient
+    tStart = time.time()
+    (f0, df) = f(X, *args)                          # get function value and gradient
+    counts['ftime'] += time.time() - tStart
+    counts['funevals'] += 1
+    df0 = dfBuffers[0]; df0[...] = df
     fX = [f0]
     i = i + (length<0)                                         # count epochs?!
-    s = -df0; d0 = -dot(s.T,s)    # initial search direction (steepest) and slope
+    negative(df0, out=s); d0 = -dot(s.T,s)    # initial search direction (steepest) and slope
     x3 = red/(1.0-d0)                             # initial step is red/(|s|+1)
 
     while i < abs(length):                                 # while not finished
         i = i + (length>0)                                 # count iterations?!
 
-        X0 = X; F0 = f0; dF0 = df0              # make a copy of current values
+        line[0] += 1; counts['linesearches'] += 1
+        X0 = 0; F0 = f0; dF0 = df0              # make a copy of current values
+                                           # (the best point is X + X0*s)
         if length>0:
             M = MAX
         else: 
@@ -92,7 +143,7 @@ def minimize(X, f, args, maxnumlinesearch=None, maxnumfuneval=None, red=1.0, ver
             while (not success) and (M > 0):
                 try:
                     M = M - 1; i = i + (length<0)              # count epochs?!
-                    (f3, df3) = f(X+x3*s, *args)
+                    (f3, df3) = evaluate(x3)
                     if isnan(f3) or isinf(f3) or any(isnan(df3)+isinf(df3)):
                         print "    error"
                         return
@@ -100,7 +151,7 @@ def minimize(X, f, args, maxnumlinesearch=None, maxnumfuneval=None, red=1.0, ver
                 except:                    # catch any error which occured in f
                     x3 = (x2+x3)/2                       # bisect and try again
             if f3 < F0:
-                X0 = X+x3*s; F0 = f3; dF0 = df3   # keep best values
+                X0 = x3; F0 = f3; dF0 = df3   # keep best values
             d3 = dot(df3.T,s)                                         # new slope
             if d3 > SIG*d0 or f3 > f0+x3*RHO*d0 or M == 0:  
                                                    # are we done extrapolating?
@@ -144,30 +195,35 @@ def minimize(X, f, args, maxnumlinesearch=None, maxnumfuneval=None, red=1.0, ver
                 x3 = (x2+x4)/2      # if we had a numerical problem then bisect
             x3 = max(min(x3, x4-INT*(x4-x2)),x2+INT*(x4-x2))  
                                                        # don't accept too close
-            (f3, df3) = f(X+x3*s, *args)
+            (f3, df3) = evaluate(x3)
             if f3 < F0:
-                X0 = X+x3*s; F0 = f3; dF0 = df3              # keep best values
+                X0 = x3; F0 = f3; dF0 = df3              # keep best values
             M = M - 1; i = i + (length<0)                      # count epochs?!
             d3 = dot(df3.T,s)                                         # new slope
 
         if abs(d3) < -SIG*d0 and f3 < f0+x3*RHO*d0:  # if line search succeeded
-            X = X+x3*s; f0 = f3; fX.append(f0)               # update variables
-            if verbose: print '    %s %6i;  Value %4.6e\r' % (S, i, f0)
-            s = (dot(df3.T,df3)-dot(df0.T,df3))/dot(df0.T,df0)*s - df3
+            takeStep(x3); f0 = f3; fX.append(f0)               # update variables
+            if verbose: record('minimize.linesearch', method='cg', iteration=i, value=float(f0))
+            s *= (dot(df3.T,df3)-dot(df0.T,df3))/dot(df0.T,df0); s -= df3
                                                   # Polack-Ribiere CG direction
             df0 = df3                                        # swap derivatives
             d3 = d0; d0 = dot(df0.T,s)
             if d0 > 0:                             # new slope must be negative
-                s = -df0; d0 = -dot(s.T,s)     # otherwise use steepest direction
+                negative(df0, out=s); d0 = -dot(s.T,s)     # otherwise use steepest direction
             x3 = x3 * min(RATIO, d3/(d0-SMALL))     # slope ratio but max RATIO
             ls_failed = 0                       # this line search did not fail
         else:
-            X = X0; f0 = F0; df0 = dF0              # restore best point so far
+            takeStep(X0); f0 = F0; df0 = dF0              # restore best point so far
             if ls_failed or (i>abs(length)):# line search failed twice in a row
                 break                    # or we ran out of time, so we give up
-            s = -df0; d0 = -dot(s.T,s)                             # try steepest
+            negative(df0, out=s); d0 = -dot(s.T,s)                             # try steepest
             x3 = 1/(1-d0)                     
             ls_failed = 1                             # this line search failed
-    if verbose: print
+    if stats is not None:
+        stats.update(counts)
+    if verbose:
+        record('minimize.done', method='cg', evaluations=counts['funevals'],
+               repeated=counts['cachehits'], linesearches=counts['linesearches'],
+               fseconds=counts['ftime'])
     return X, fX, i
 
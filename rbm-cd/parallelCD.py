@@ -0,0 +1,232 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+import time
+import traceback
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+from flattenUtils import multiSize, multiView
+from datasetUtils import ArraySource
+from randomStreams import batchStream
+from CDSampler import CDSampler
+from telemetry import record
+
+
+## batchCD1 with several worker processes (one per core, by default).
+## At batch size 100, BLAS barely uses more than one core, so instead
+## each worker trains on its own batches:  worker w takes batches
+## w, w + numWorkers, w + 2*numWorkers, ... of every epoch.
+##
+## The network's parameters are moved into shared memory first, so all
+## the workers see (and change) the same weights.  Two modes:
+##
+##   'sync'    - synchronous averaging:  each round, every worker
+##               computes the CD changes for one batch (into its own slot
+##               of a shared array), and the main process averages them
+##               and takes one momentum step.  This is CD on batches
+##               numWorkers times bigger, with the same learning rate.
+##   'hogwild' - asynchronous (Hogwild!, Niu et al, 2011):  every
+##               worker takes momentum steps on the shared weights as it
+##               goes, with no locking.  The updates are small and
+##               mostly touch different values at different times, so
+##               the occasional lost update doesn't matter much.
+##
+## The workers are forked, so this needs a Unix-like system.  The input
+## data must be an array (or memmap) so that each worker can take its
+## own batches; the other arguments are as for batchCD1.  Reproducible
+## runs (with a seed) are only reproducible in 'sync' mode.
+
+def parallelBatchCD1(nn, whichLayer, allInputData, maxepoch=10, seed=None,
+                     batchsize=100, shuffle=False, randomState=np.random,
+                     keepHidProbs=True, hidProbsFile=None, k=1, persistent=False,
+                     numWorkers=None, mode='sync'):
+    if not isinstance(allInputData, np.ndarray):
+        raise Exception("parallelBatchCD1 needs its input data in an array (or memmap).")
+    if mode not in ('sync', 'hogwild'):
+        raise Exception("Unknown mode:  %r" % (mode,))
+    if numWorkers is None:
+        numWorkers = multiprocessing.cpu_count()
+    source = ArraySource(allInputData, nn.dtype)
+    numCases = source.numCases
+    (numvis, numhid) = nn.W[whichLayer].shape
+    numbatches = -(-numCases // batchsize)
+
+    print "Pretraining Layer %d.  %d visible units, %d hidden units." % (whichLayer, numvis, numhid)
+    print "Doing %d epochs * %d batches of (up to) %d cases, with %d %s workers." % (
+        maxepoch, numbatches, batchsize, numWorkers, mode)
+
+    #### Move the parameters into shared memory (the old array's values
+    #### are copied over, and nn.W, hB and vB now view the shared one):
+    shared = sharedArray(nn.parameters.shape, nn.dtype)
+    shared[...] = nn.parameters
+    nn.allocateParameters(nn.layerSizes, shared)
+
+    ## The order of the cases in each epoch, and the output:
+    order = sharedArray(numCases, np.intp)
+    if keepHidProbs and hidProbsFile:
+        batchHidProbs = np.lib.format.open_memmap(hidProbsFile, mode='w+', dtype=nn.dtype,
+                                                  shape=(numCases, numhid))
+    elif keepHidProbs:
+        batchHidProbs = sharedArray((numCases, numhid), nn.dtype)
+    else:
+        batchHidProbs = None
+
+    ## For 'sync', one slot per worker for its changes (W, vB, hB):
+    deltaDim = [(numvis, numhid), (1, numvis), (1, numhid)]
+    slots = sharedArray((numWorkers, multiSize(deltaDim)), nn.dtype)
+
+    workers = []
+    for w in range(numWorkers):
+        (conn, workerConn) = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=cdWorker, args=(
+            workerConn, w, numWorkers, mode, nn, whichLayer, source, order,
+            batchHidProbs, multiView(slots[w], deltaDim), seed, batchsize, k,
+            persistent))
+        process.daemon = True
+        process.start()
+        workers.append((process, conn))
+    conns = [ conn for (process, conn) in workers ]
+
+    velocity = np.zeros(multiSize(deltaDim), nn.dtype)
+    average = np.empty_like(velocity)
+    velocities = multiView(velocity, deltaDim)
+    parameters = [nn.W[whichLayer], nn.vB[whichLayer], nn.hB[whichLayer]]
+
+    initialmomentum = 0.5
+    finalmomentum = 0.9
+
+    try:
+        for epoch in xrange(maxepoch):
+            tStart = time.time()
+            print "epoch ", epoch
+            if (epoch > 4):
+                momentum = finalmomentum
+            else:
+                momentum = initialmomentum
+            if shuffle:
+                if seed is not None:
+                    randomState = batchStream(seed, whichLayer, epoch)
+                order[...] = randomState.permutation(numCases)
+
+            lastEpoch = (epoch == maxepoch - 1)
+            for conn in conns:
+                conn.send((epoch, momentum, shuffle, lastEpoch))
+
+            errsum = 0.
+            if mode == 'hogwild':
+                for conn in conns:
+                    errsum += receive(conn)
+            else:
+                active = range(numWorkers)
+                step = 0
+                while active:
+                    record('cd.step', layer=whichLayer, epoch=epoch, step=step)
+                    ## Each active worker sends the error of its batch, or
+                    ## None when it has no batches left:
+                    contributed = []
+                    for w in active:
+                        err = receive(conns[w])
+                        if err is not None:
+                            errsum += err
+                            contributed.append(w)
+                    active = contributed
+                    if not active:
+                        break
+
+                    average[...] = slots[active[0]]
+                    for w in active[1:]:
+                        average += slots[w]
+                    average *= 1. / len(active)
+                    velocity *= momentum
+                    velocity += average
+                    # (In place:  the weights are views of nn.parameters.)
+                    for (parameter, change) in zip(parameters, velocities):
+                        parameter += change
+                    for w in active:
+                        conns[w].send(True)           # go on to the next batch
+                    step += 1
+
+            tEnd = time.time()
+            record('cd.epoch', layer=whichLayer, epoch=epoch, seconds=tEnd-tStart,
+                   error=float(errsum))
+            print "epoch %d error %6.1f" % (epoch, errsum)
+            print "total time: %.3f seconds\n" % (tEnd-tStart)
+    finally:
+        ## (A worker that is waiting for the next step stops as well.)
+        for (process, conn) in workers:
+            try:
+                conn.send(None)
+            except IOError:
+                pass                                 # (it has already failed)
+        for (process, conn) in workers:
+            process.join()
+
+    if whichLayer < 3:
+        nn.lowerLayersChanged()
+    if hidProbsFile and batchHidProbs is not None:
+        batchHidProbs.flush()
+    return batchHidProbs
+
+
+def sharedArray(shape, dtype):
+    ## An array in (anonymous) shared memory, which forked processes share.
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buffer = RawArray('b', max(size, 1) * dtype.itemsize)
+    return np.frombuffer(buffer, dtype, size).reshape(shape)
+
+
+def receive(conn):
+    message = conn.recv()
+    if isinstance(message, tuple) and message[0] == 'error':
+        raise Exception("A CD worker failed:\n" + message[1])
+    return message
+
+
+def cdWorker(conn, w, numWorkers, mode, nn, whichLayer, source, order,
+             batchHidProbs, slot, seed, batchsize, k, persistent):
+    try:
+        ## (Forked processes start with the same global random state.)
+        np.random.seed()
+        sampler = CDSampler(nn, whichLayer, batchsize, k, persistent)
+        if mode == 'sync':
+            ## cd() then leaves its changes straight in our shared slot:
+            (sampler.deltaW, sampler.deltaVB, sampler.deltaHB) = slot
+
+        while True:
+            message = conn.recv()
+            if message is None:
+                break
+            (epoch, momentum, shuffle, lastEpoch) = message
+            errsum = 0.
+            batch = w
+            for (where, inputData) in source.batches(batchsize,
+                                                     order=(order if shuffle else None),
+                                                     first=w, step=numWorkers):
+                if seed is not None:
+                    rng = batchStream(seed, whichLayer, epoch, batch)
+                else:
+                    rng = None
+                if mode == 'sync':
+                    (dW, dVB, dHB, poshidprobs, err) = sampler.cd(inputData, rng)
+                else:
+                    (poshidprobs, err) = sampler.train(inputData, momentum, rng)
+                if lastEpoch and batchHidProbs is not None:
+                    batchHidProbs[where] = poshidprobs
+                if mode == 'sync':
+                    conn.send(err)
+                    if conn.recv() is None:   # wait for the step to be taken
+                        return
+                else:
+                    errsum += err
+                batch += numWorkers
+            if mode == 'sync':
+                conn.send(None)
+            else:
+                conn.send(errsum)
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
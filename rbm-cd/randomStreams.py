@@ -0,0 +1,43 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+import numpy as np
+
+
+### Reproducible random numbers for pretraining, without reading them
+### from files.  Every (layer, epoch, batch) has its own stream, which
+### depends only on the seed and those three numbers, so any batch can
+### be reproduced on its own, without replaying the batches before it.
+###
+### With numpy >= 1.17, the streams come from Philox, a counter-based
+### generator:  the seed is its key, and (layer, epoch, batch) are put
+### in the upper words of its 256-bit counter, so that the streams can
+### never overlap.  Older versions of numpy fall back on a Mersenne
+### Twister seeded with all four numbers.
+
+def batchStream(seed, layer, epoch, batch=None):
+    ## batch=None gives the stream for the epoch as a whole (eg, for
+    ## shuffling), which is separate from every batch's stream.
+    index = 0 if batch is None else batch + 1
+    if hasattr(np.random, 'Philox'):
+        bitGenerator = np.random.Philox(key=seed, counter=[0, index, epoch, layer])
+        return np.random.Generator(bitGenerator)
+    return np.random.RandomState([seed, layer, epoch, index])
+
+
+def uniform(rng, shape, dtype=np.float64, out=None):
+    ## Uniform random numbers in [0, 1), from either kind of stream, or
+    ## from numpy's global random state if rng is None.  With 'out', they
+    ## are written into that array instead (which only avoids allocating
+    ## anything with a Philox stream).
+    if rng is None or isinstance(rng, np.random.RandomState):
+        numbers = (rng or np.random).random_sample(shape)
+        if out is None:
+            return numbers.astype(dtype, copy=False)
+        out[...] = numbers
+        return out
+    if out is None:
+        return rng.random(shape, dtype=dtype)
+    return rng.random(out=out, dtype=out.dtype)
@@ -1,60 +1,151 @@
 #!/usr/bin/python
 
-import time, sys, os
+import time, sys, os, atexit
 import numpy as np
 import scipy.io as sio
 
 import NeuralNetwork
+import telemetry
+from memoryUtils import MemoryTracker, planMemory, printPlan, parseBytes
 
 from batchCD1 import batchCD1
+from parallelCD import parallelBatchCD1
+from datasetUtils import loadDataset, numClassesOf, scaleBatch, RecognitionSource
 
 ## We want a Restricted Boltzmann Machine (RBM) which is a type of
 ## neural network.  Specifically, we want the 4-layer model described
 ## in (Hinton, Osindero, Teh, 2006).
-nn = NeuralNetwork.LogisticHinton2006()
+## (Use np.float32 for about twice the speed and half the memory.)
+dtype = np.float64
+## For a reproducible run, set seed to an integer.  (Pretraining then
+## takes its random numbers from seeded streams, see randomStreams.py.)
+seed = None
+## Progress (every batch's reconstruction error, time and GFLOP/s; see
+## telemetry.py) is shown at most every progressInterval seconds, and
+## all of it is written to telemetryFile, unless it is None.
+progressInterval = 5.0
+telemetryFile = 'nnData/step1-telemetry.jsonl'
+if telemetryFile:
+    telemetry.setSinks(telemetry.ConsoleSink(progressInterval),
+                       telemetry.JSONLSink(telemetryFile))
+else:
+    telemetry.setSinks(telemetry.ConsoleSink(progressInterval))
+## (The sinks are closed however the script ends.)
+atexit.register(telemetry.close)
+if seed is not None:
+    np.random.seed(seed)
+nn = NeuralNetwork.LogisticHinton2006(dtype)
 nn.initRBM()
 
 # Load the MNIST training data:
-trainData = sio.loadmat('../datasets/MNIST/trainImagesAndTargets.mat', struct_as_record=True)
-
-trainImages = trainData['images']
-trainTargets = trainData['targets']
-assert trainImages.shape[0] == trainTargets.shape[0]
+(trainImages, trainLabels) = loadDataset('../datasets/MNIST/trainImagesAndTargets')
+assert trainImages.shape[0] == trainLabels.shape[0]
 
 
 ## We use a "batched" version of 1-step Constrastive Divergence (CD) to 
 ## pre-train the first 3 layers (0,1,2) of our neural network.  
-
-layer0out = batchCD1(nn, 0, trainImages, maxepoch=5)
+## The cases are taken in batches of 'batchsize', in a new random order
+## every epoch.  (Set shuffle = False to always use the stored order.)
+batchsize = 100
+shuffle = True
+## Prepare each batch on a background thread while the one before it
+## is being trained on:
+prefetchBatches = True
+## Each batch takes cdSteps steps of Gibbs sampling (CD-k), and with
+## persistent = True, the sampling chains carry on from batch to batch
+## (Persistent CD, which mixes better).  See CDSampler.py.
+cdSteps = 1
+persistent = False
+## With numWorkers > 1, each layer is pretrained by that many worker
+## processes, with synchronous ('sync') or lock-free asynchronous
+## ('hogwild') updates of weights in shared memory.  See parallelCD.py.
+## (This needs the layers' outputs in arrays, so not 'recompute' below.)
+numWorkers = 1
+parallelMode = 'sync'
+
+## Each layer is trained on the output of the layers below it, which is
+## numCases x numhid values (60000 x 2000 for layer 2).  That output can
+##   'memory'    - be kept in memory (the fastest),
+##   'spill'     - be written to a memory-mapped scratch file (scratchFile,
+##                 below), so it is paged in and out by the OS, or
+##   'recompute' - not be kept at all, but recomputed from the trained
+##                 lower layers a batch at a time, every epoch.  Memory
+##                 use then depends on the batch size, not on the size
+##                 of the dataset.
+layerOutputs = 'memory'
+scratchFile = 'nnData/layer%dout.npy'
+## With a memoryBudget (in bytes, eg parseBytes('4G')), the outputs are
+## spilled if keeping them in memory wouldn't fit (see memoryUtils.py).
+## Either way, the memory used by each layer is reported at the end.
+memoryBudget = None
+if memoryBudget:
+    plan = planMemory(memoryBudget, trainImages.shape[0], nn.layerSizes, dtype, batchsize)
+    printPlan(plan, memoryBudget)
+    if layerOutputs == 'memory':
+        layerOutputs = plan['layerOutputs']
+memory = MemoryTracker()
+
+def pretrainLayer(whichLayer, inputData):
+    ## Returns the input data for the next layer up.
+    options = dict(maxepoch=5, seed=seed, batchsize=batchsize, shuffle=shuffle,
+                   k=cdSteps, persistent=persistent)
+    if numWorkers > 1:
+        train = parallelBatchCD1
+        options.update(numWorkers=numWorkers, mode=parallelMode)
+    else:
+        train = batchCD1
+        options.update(prefetchBatches=prefetchBatches)
+    if layerOutputs == 'memory':
+        return train(nn, whichLayer, inputData, **options)
+    elif layerOutputs == 'spill':
+        return train(nn, whichLayer, inputData,
+                     hidProbsFile=scratchFile % whichLayer, **options)
+    elif layerOutputs == 'recompute':
+        train(nn, whichLayer, inputData, keepHidProbs=False, **options)
+        return RecognitionSource(nn, whichLayer+1, trainImages)
+    else:
+        raise Exception("Unknown layerOutputs:  %r" % (layerOutputs,))
+
+memory.start('pretrain layer0')
+layer0out = pretrainLayer(0, trainImages)
+memory.stop()
 
 ### To save here:
 #nn.save('...filename...')
 
 ### To restart here:
 #nn.load('...filename...')
-#layer0out = nn.up0(trainImages)
+#layer0out = nn.up0(scaleBatch(trainImages, dtype))
 
-layer1out = batchCD1(nn, 1, layer0out, maxepoch=5)
+memory.start('pretrain layer1')
+layer1out = pretrainLayer(1, layer0out)
+memory.stop()
 
 ### To save here:
 #nn.save('...filename...')
 
 ### To restart here:
 #nn.load('...filename...')
-#layer0out = nn.up0(trainImages)
+#layer0out = nn.up0(scaleBatch(trainImages, dtype))
 #layer1out = nn.up1(layer0out)
 
-layer2out = batchCD1(nn, 2, layer1out, maxepoch=5)
+memory.start('pretrain layer2')
+layer2out = pretrainLayer(2, layer1out)
+memory.stop()
 
 
 ### Give layer3 some random biases:
 l3numVis = nn.W[2].shape[1]
-l3numHid = trainTargets.shape[1]
+l3numHid = numClassesOf(trainLabels)
 
-nn.vB[3] = 0.1*np.random.randn(1, l3numVis)
-nn.hB[3] = 0.1*np.random.randn(1, l3numHid)
+assert nn.hB[3].shape == (1, l3numHid)
+
+nn.vB[3][...] = 0.1*np.random.randn(1, l3numVis)
+nn.hB[3][...] = 0.1*np.random.randn(1, l3numHid)
 
 # Save the pre-trained neural network:
-nn.save('nnData/NN_afterPreTrain.mat')
+nn.save('nnData/NN_afterPreTrain.nn')
+
+memory.report()
 
 
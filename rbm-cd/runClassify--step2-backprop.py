@@ -21,81 +21,144 @@
 
 
 
-import time, sys
+import time, sys, multiprocessing, atexit
 import numpy as np
 import scipy.io as sio
 
 import NeuralNetwork
+import telemetry
+from memoryUtils import MemoryTracker, planMemory, printPlan, parseBytes
+import minimize as cg
+from lbfgs import lbfgs
+from sgdFineTune import SGDFineTuner, learningRateSchedule
+from Evaluator import Evaluator
+from ChunkedGradient import ChunkedGradient
+from backprop import backprop, backprop_only3
+from datasetUtils import loadDataset, numClassesOf, BatchLoader, prefetch
+
+## (Use np.float32 for about twice the speed and half the memory.  The
+## network is converted to this dtype when it is loaded.)
+dtype = np.float64
+nn = NeuralNetwork.LogisticHinton2006(dtype)
+
+## The optimizer used for each batch:  cg.minimize (conjugate gradients)
+## or lbfgs (limited-memory BFGS, which usually needs fewer backprop()
+## evaluations per batch).  Either way, max_iter (below) is the number
+## of line searches per batch.  (For a budget of function evaluations
+## instead, use eg:
+##    optimizer = lambda X, f, args, n: lbfgs(X, f, args, maxnumfuneval=6, m=5)
+## )
+optimizer = cg.minimize
+
+## Each batch's gradient can be computed in chunks of gradientChunkSize
+## cases, shared out between gradientThreads threads (see
+## ChunkedGradient.py).  That bounds the memory used by backprop(), so
+## batches can be much bigger, and uses more cores.  None computes the
+## whole batch in one go.
+gradientChunkSize = None
+gradientThreads = 1
+
+## mode = 'sgd' fine-tunes with small minibatches and momentum (see
+## sgdFineTune.py) instead:  one backprop() per minibatch, so it gets
+## through many more cases per second.  As with the optimizers, only
+## layer 3 is trained for the first five epochs.
+mode = 'cg'
+sgdBatchSize = 100
+sgdMomentum = 0.9
+sgdNesterov = False
+learningRate = lambda epoch: learningRateSchedule(epoch, 0.1, 0.9)
+
+## Progress (every batch's error, time, GFLOP/s, ...; see telemetry.py)
+## is shown at most every progressInterval seconds, and all of it is
+## written to telemetryFile (one JSON record per line), unless it is None.
+progressInterval = 5.0
+telemetryFile = 'nnData/step2-telemetry.jsonl'
+if telemetryFile:
+    telemetry.setSinks(telemetry.ConsoleSink(progressInterval),
+                       telemetry.JSONLSink(telemetryFile))
+else:
+    telemetry.setSinks(telemetry.ConsoleSink(progressInterval))
+## (The sinks are closed however the script ends.)
+atexit.register(telemetry.close)
 
-nn = NeuralNetwork.LogisticHinton2006()
 # Load the neural network that was created from step1:
-nn.load('nnData/NN_afterPreTrain.mat');
+nn.load('nnData/NN_afterPreTrain.nn');
 
 
 #### START:  Load the MNIST training and testing data
 print
 sys.stdout.write("Loading training data...")
 sys.stdout.flush()
-trainData = sio.loadmat('../datasets/MNIST/trainImagesAndTargets.mat', struct_as_record=True)
+(trainImages, trainLabels) = loadDataset('../datasets/MNIST/trainImagesAndTargets')
 print " done."
 
 sys.stdout.write("Loading testing data...")
 sys.stdout.flush()
-testData = sio.loadmat('../datasets/MNIST/testImagesAndTargets.mat', struct_as_record=True)
+(testImages, testLabels) = loadDataset('../datasets/MNIST/testImagesAndTargets')
 print " done."
 
-trainImages = trainData['images']
-trainTargets = trainData['targets']
-testImages = testData['images']
-testTargets = testData['targets']
-
 (numCases, numPixels) = trainImages.shape
-(numCases2, numTargets) = trainTargets.shape
+numCases2 = trainLabels.shape[0]
+numTargets = numClassesOf(trainLabels)
 assert numCases == numCases2
 
 (numTestCases, numPixels2) = testImages.shape
-(numTestCases2, numTargets2) = testTargets.shape
+numTestCases2 = testLabels.shape[0]
+numTargets2 = numClassesOf(testLabels)
 assert numTestCases == numTestCases2
 assert numPixels == numPixels2
-assert numTargets == numTargets2
+assert numTargets2 <= numTargets
 #### END:  Load the MNIST training and testing data
 
 
 
 
-def countErrors(inputData, targets):
-    newTargetOut = nn.recognize(inputData)
-    newTargetOut = newTargetOut/np.tile( newTargetOut.sum(1)[:, np.newaxis], (1,10) )
-    J = newTargetOut.argmax(1)
-    J1 = targets.argmax(1)
-    numErrors = np.sum(1*(J==J1))
-    errCr = - (targets * np.log(newTargetOut)).sum(0).sum(0)
-    return numErrors, errCr
-
-def batchCountErrors(allImages, allTargets, numbatches):
-    ## Divide the job into batches so that we don't run out of memory
-    ## (Here, batchsize doesn't affect results or CPU time, just memory usage.)
-    numCases = allImages.shape[0]
-    batchsize = numCases / numbatches
-    err_cr = 0.
-    counter = 0
-    for batch in xrange(numbatches):
-        sys.stdout.write("    batch %d (of %d)\r" % (batch, numbatches))
-        sys.stdout.flush()
-        start = batch * batchsize
-        stop = (batch+1) * batchsize
-
-        images = allImages[start:stop, :]
-        targets = allTargets[start:stop, :]
-
-        (numErrs, errCr) = countErrors(images, targets)
-
-        counter = counter + numErrs
-        err_cr = err_cr + errCr
-    print
-    sys.stdout.flush()
-    t_err = allImages.shape[0] - counter
-    t_crerr = err_cr / numbatches
+## Counting errors only needs the forward pass, so it uses an evaluator
+## with preallocated buffers, which scores big batches on evalThreads
+## threads (None means one per core).  On the epochs before the last,
+## only a fixed random sample of trainSampleSize training cases is
+## scored (None scores them all, every epoch).
+evalBatchSize = 1000
+evalThreads = None
+trainSampleSize = None
+
+## In the first epochs, each batch's layer-2 output is cached (see
+## below), which costs numCases x 2000 values.  With a memoryBudget (in
+## bytes, eg parseBytes('4G')), that cache, gradientChunkSize and
+## evalBatchSize are chosen so that the run fits (see memoryUtils.py).
+## Either way, the memory used by each epoch is reported at the end.
+cacheFeatures = True
+memoryBudget = None
+if memoryBudget:
+    if mode == 'sgd':
+        fineTuneBatchSize = sgdBatchSize
+    else:
+        fineTuneBatchSize = 1000
+    plan = planMemory(memoryBudget, numCases, nn.layerSizes, dtype,
+                      fineTuneBatchSize=fineTuneBatchSize,
+                      evalThreads=(evalThreads or multiprocessing.cpu_count()))
+    printPlan(plan, memoryBudget)
+    cacheFeatures = cacheFeatures and plan['featureCache']
+    gradientChunkSize = gradientChunkSize or plan['gradientChunkSize']
+    evalBatchSize = min(evalBatchSize, plan['evalBatchSize'])
+memory = MemoryTracker()
+
+if gradientChunkSize:
+    layer3Gradient = ChunkedGradient(backprop_only3, gradientChunkSize, gradientThreads)
+    allLayersGradient = ChunkedGradient(backprop, gradientChunkSize, gradientThreads)
+else:
+    layer3Gradient = backprop_only3
+    allLayersGradient = backprop
+
+evaluator = Evaluator(nn, evalBatchSize, evalThreads)
+if trainSampleSize:
+    trainSample = np.sort(np.random.RandomState(0).permutation(numCases)[:trainSampleSize])
+else:
+    trainSample = None
+
+def batchCountErrors(allImages, allLabels, cases=None):
+    (t_err, err_cr, numCases) = evaluator.evaluate(allImages, allLabels, cases)
+    t_crerr = err_cr * 100. / numCases         # (per 100 cases, as it used to be)
     percent_error = 100 * float(t_err) / float(numCases)
 
     print "    Misclassified %d out of %d images.  (%.2f%% error)" % (t_err, numCases, percent_error)
@@ -106,10 +169,10 @@ print
 print "Before doing any backprop:"
 
 print "  Counting the number of mis-classifications in the training set..."
-(pre_train_err, pre_train_crerr) = batchCountErrors(trainImages, trainTargets, 600)
+(pre_train_err, pre_train_crerr) = batchCountErrors(trainImages, trainLabels)
 
 print "  Counting the number of mis-classifications in the test set..."
-(pre_test_err, pre_test_crerr) = batchCountErrors(testImages, testTargets, 100)
+(pre_test_err, pre_test_crerr) = batchCountErrors(testImages, testLabels)
 
 print
 print ' === Training model by minimizing cross entropy error === '
@@ -119,38 +182,62 @@ test_err = [0]*maxepoch
 train_err = [0]*maxepoch
 test_crerr = [0.]*maxepoch
 train_crerr = [0.]*maxepoch
+if mode == 'sgd':
+    tuner = SGDFineTuner(nn, sgdMomentum, sgdNesterov)
 for epoch in xrange(maxepoch):
     print "Starting epoch", epoch
-    ## Divide the data into 60 batches to save memory
-    assert numCases == 60000, "Expecting 60,000 training images."
-    numbatches = 60
-    batchsize = 1000
-    assert batchsize*numbatches == numCases
-    print '  %d batches of %d cases each.' % (numbatches, batchsize)
-
-    for batch in xrange(numbatches):
-        print "    batch %d of %d:" % (batch, numbatches)
-        start = batch * batchsize
-        stop = (batch+1) * batchsize
-
-        data = trainImages[start:stop, :]
-        targets = trainTargets[start:stop, :]
-
-        ### START:  Conjugate gradient with 3 linesearches
-        max_iter = 3
-
-        if (epoch < 5):  # At first, we only update the final layer
-            nn.minimizeLayer3(data, targets, max_iter)
-        else:
-            nn.minimizeAllLayers(data, targets, max_iter)
-
+    memory.start('fine-tune epoch %d' % epoch)
+    if mode == 'sgd':
+        loader = BatchLoader(trainImages, trainLabels, sgdBatchSize, numTargets, dtype)
+        print '  SGD:  %d minibatches of %d cases, learning rate %g.' % (
+            loader.numbatches, sgdBatchSize, learningRate(epoch))
+        ## At first, we only update the final layer (with the lower
+        ## layers' output cached, as below):
+        tuner.epoch(loader, learningRate(epoch), onlyLayer3=(epoch < 5),
+                    cacheFeatures=cacheFeatures)
+    else:
+        ## Divide the data into 60 batches to save memory
+        assert numCases == 60000, "Expecting 60,000 training images."
+        numbatches = 60
+        batchsize = 1000
+        assert batchsize*numbatches == numCases
+        print '  %d batches of %d cases each.' % (numbatches, batchsize)
+        loader = BatchLoader(trainImages, trainLabels, batchsize, numTargets, dtype)
+
+        ## (Each batch is prepared on another thread while the one before
+        ## it is being trained on.)
+        batches = prefetch(loader.getBatch(batch) for batch in xrange(numbatches))
+        for (batch, (data, targets)) in enumerate(batches):
+            ### START:  Conjugate gradient (or L-BFGS) with 3 linesearches
+            max_iter = 3
+
+            if (epoch < 5):  # At first, we only update the final layer
+                ## The lower layers don't change in these epochs, so each
+                ## batch's layer-2 output is computed once and cached.
+                ## (It costs 60000 x 2000 activations of memory, until
+                ## minimizeAllLayers() drops the cache.  Without
+                ## cacheFeatures, it is recomputed every time.)
+                nn.minimizeLayer3(data, targets, max_iter,
+                                  cacheKey=(batch if cacheFeatures else None),
+                                  optimizer=optimizer, gradient=layer3Gradient)
+            else:
+                nn.minimizeAllLayers(data, targets, max_iter, optimizer=optimizer,
+                                     gradient=allLayersGradient)
+
+    memory.start('evaluation %d' % epoch)
     print "After Epoch %d:" % (epoch)
     print "  Counting the number of mis-classifications in the training set..."
-    (train_err[epoch], train_crerr[epoch]) = batchCountErrors(trainImages, trainTargets, 600)
+    if epoch < maxepoch - 1:
+        cases = trainSample
+    else:
+        cases = None
+    (train_err[epoch], train_crerr[epoch]) = batchCountErrors(trainImages, trainLabels, cases)
  
     print "  Counting the number of mis-classifications in the test set..."
-    (test_err[epoch], test_crerr[epoch]) = batchCountErrors(testImages, testTargets, 100)
+    (test_err[epoch], test_crerr[epoch]) = batchCountErrors(testImages, testLabels)
+    memory.stop()
 
     print
     print
 
+memory.report()
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+import time
+import numpy as np
+
+from backprop import backprop, backprop_only3, backpropFlops
+from datasetUtils import prefetch
+from telemetry import record, gflops
+
+
+## Stochastic fine-tuning:  instead of a few conjugate-gradient line
+## searches on each batch of 1000 cases (several backprop() calls per
+## batch), take one step per small minibatch, with momentum:
+##
+##    velocity = momentum * velocity - learningRate * gradient
+##    weights += velocity
+##
+## or with Nesterov momentum, which takes the gradient after the
+## momentum step.  We use the usual rearrangement, so that the gradient
+## is still taken at the stored weights:
+##
+##    weights -= momentum * velocity
+##    velocity = momentum * velocity - learningRate * gradient
+##    weights += (1 + momentum) * velocity
+##
+## The gradient from backprop() is summed over the minibatch, so it is
+## divided by the number of cases:  learningRate is per case, and
+## doesn't need to change with the minibatch size.
+##
+## Everything is updated in place in nn.parameters, and the velocity,
+## gradient and scratch arrays are allocated once.
+
+class SGDFineTuner:
+    def __init__(self, nn, momentum=0.9, nesterov=False):
+        self.nn = nn
+        self.momentum = momentum
+        self.nesterov = nesterov
+
+        numParameters = nn.fineTuneEnd
+        self.velocity = np.zeros(numParameters, nn.dtype)
+        self.gradient = np.empty(numParameters, nn.dtype)
+        self.scratch = np.empty(numParameters, nn.dtype)
+
+    def step(self, VV, f, args, learningRate, start):
+        ## One update of VV, the parameters from 'start' on (the velocity
+        ## and buffers are sliced to match).  Returns f's error value.
+        stop = start + VV.shape[0]
+        velocity = self.velocity[start:stop]
+        gradient = self.gradient[start:stop]
+        scratch = self.scratch[start:stop]
+        momentum = self.momentum
+
+        numcases = args[1].shape[0]
+        (err, df) = f(VV, *(args + (gradient,)))
+        gradient *= learningRate / numcases
+
+        if self.nesterov:
+            np.multiply(velocity, momentum, out=scratch)
+            VV -= scratch
+        velocity *= momentum
+        velocity -= gradient
+        if self.nesterov:
+            np.multiply(velocity, 1. + momentum, out=scratch)
+            VV += scratch
+        else:
+            VV += velocity
+        return err
+
+    ## Like nn.minimizeLayer3 and nn.minimizeAllLayers, but one step each.
+
+    def minimizeLayer3(self, inputData, targets, learningRate, cacheKey=None):
+        nn = self.nn
+        layer2out = nn.layer2Features(inputData, cacheKey)
+        VV = nn.parameters[nn.layer3Start:nn.fineTuneEnd]
+        return self.step(VV, backprop_only3, (nn.Dim[6:8], layer2out, targets),
+                         learningRate, nn.layer3Start)
+
+    def minimizeAllLayers(self, inputData, targets, learningRate):
+        nn = self.nn
+        VV = nn.parameters[:nn.fineTuneEnd]
+        err = self.step(VV, backprop, (nn.Dim, inputData, targets),
+                        learningRate, 0)
+        nn.lowerLayersChanged()
+        return err
+
+    def epoch(self, loader, learningRate, onlyLayer3=False, cacheFeatures=True):
+        ## One pass over the loader's minibatches.  With onlyLayer3, the
+        ## lower layers are frozen, and their output for each minibatch
+        ## is cached (by batch number) for the following epochs (unless
+        ## cacheFeatures is False, when it is recomputed).  The
+        ## next minibatch is prepared on another thread meanwhile.  Each
+        ## minibatch is reported to telemetry, as an 'sgd.batch' record.
+        nn = self.nn
+        tStart = time.time()
+        errsum = 0.
+        batches = prefetch(loader.getBatch(batch) for batch in xrange(loader.numbatches))
+        for (batch, (data, targets)) in enumerate(batches):
+            numcases = data.shape[0]
+            tBatch = time.time()
+            if onlyLayer3:
+                err = self.minimizeLayer3(data, targets, learningRate,
+                                          cacheKey=(batch if cacheFeatures else None))
+                flops = backpropFlops(nn.Dim[6:8], numcases)
+            else:
+                err = self.minimizeAllLayers(data, targets, learningRate)
+                flops = backpropFlops(nn.Dim, numcases)
+            seconds = time.time() - tBatch
+            record('sgd.batch', batch=batch, cases=numcases, seconds=seconds,
+                   gflops=gflops(flops, seconds), error=float(err))
+            errsum += err
+        seconds = time.time() - tStart
+        numCases = loader.numbatches * loader.batchsize
+        print "    cross-entropy %.1f, %.0f cases per second" % (errsum, numCases / seconds)
+        return errsum
+
+
+## A learning rate schedule:  initial, multiplied by 'decay' every epoch.
+def learningRateSchedule(epoch, initial=0.1, decay=0.9):
+    return initial * decay ** epoch
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+import numpy as np
+
+
+### The top layer of the network is a softmax over the classes, and we
+### train it with the cross-entropy error.  Doing it naively (exp, then
+### normalise with a tiled copy of the row sums, then log) costs extra
+### passes and temporaries, and exp() overflows to inf/NaN for large
+### logits.  These work in place on the logits, with the log-sum-exp
+### trick:  subtracting each row's max changes nothing mathematically,
+### but keeps every exp() <= 1.
+###
+### rowBuffer is optional scratch space of shape (>= numcases, 1), for
+### callers that don't want anything allocated.
+
+def softmax(logits, rowBuffer=None):
+    ## In place:  logits become the class probabilities.
+    if rowBuffer is None:
+        rowBuffer = np.empty((logits.shape[0], 1), logits.dtype)
+    rowBuffer = rowBuffer[:logits.shape[0]]
+    np.amax(logits, axis=1, out=rowBuffer[:, 0])
+    logits -= rowBuffer
+    np.exp(logits, out=logits)
+    np.sum(logits, axis=1, out=rowBuffer[:, 0])
+    logits /= rowBuffer
+    return logits
+
+
+def softmaxCrossEntropy(logits, targets, gradient=True, rowBuffer=None):
+    ## Returns the cross-entropy error, -sum(targets * log(softmax(logits))),
+    ## summed over all cases.  In place:  logits become the class
+    ## probabilities, or, with gradient=True, the gradient of the error
+    ## with respect to the logits (probabilities - targets).
+    if rowBuffer is None:
+        rowBuffer = np.empty((logits.shape[0], 1), logits.dtype)
+    rowBuffer = rowBuffer[:logits.shape[0]]
+
+    np.amax(logits, axis=1, out=rowBuffer[:, 0])
+    logits -= rowBuffer
+    ## With z = logits - max, and log(p) = z - log(sum(exp(z))):
+    targetsDotZ = np.einsum('ij,ij->', targets, logits)
+
+    np.exp(logits, out=logits)
+    np.sum(logits, axis=1, out=rowBuffer[:, 0])
+    logits /= rowBuffer
+
+    np.log(rowBuffer, out=rowBuffer)
+    f = np.einsum('ij,ik->', targets, rowBuffer) - targetsDotZ
+
+    if gradient:
+        logits -= targets
+    return f
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+import sys
+import time
+import json
+from collections import deque
+
+
+### Progress reports from the training code, as records (dicts) instead
+### of lines on stdout.  The training code calls
+###
+###    record('cd.batch', layer=0, epoch=3, batch=17, seconds=0.11, ...)
+###
+### which adds the record's 'kind' and 'time' (time.time()), and hands
+### it to the current sink.  A sink is anything with write(record) and
+### close():
+###
+###    NullSink      - throws the records away
+###    JSONLSink     - appends them to a file, one JSON object per line
+###    RingSink      - keeps the last 'size' of them in memory (.records)
+###    ConsoleSink   - prints at most one every 'interval' seconds (and
+###                    every record of the kinds in 'always')
+###
+### Use several at once with setSinks(sink1, sink2, ...), and close()
+### them at the end of the run.  By default,
+### records go to a ConsoleSink, so there is still some progress on the
+### screen, without a line (and a flush) for every batch.
+###
+### The kinds of records, and their fields:
+###    cd.batch          layer, epoch, batch, cases, seconds, gflops, error
+###                      (error is the reconstruction error, beliefError)
+###    cd.epoch          layer, epoch, seconds, error
+###    cd.step           layer, epoch, step  (parallelCD's 'sync' mode)
+###    minimize.linesearch  method ('cg' or 'lbfgs'), iteration, value
+###    minimize.done     method, evaluations, linesearches, fseconds (the
+###                      time in f), and for 'cg', repeated
+###    finetune.batch    layers ('3' or 'all'), cases, evaluations,
+###                      linesearches, value, seconds, gflops
+###    sgd.batch         batch, cases, seconds, gflops, error
+###    eval              cases, errors, crossEntropy, seconds
+
+class NullSink:
+    def write(self, record):
+        pass
+
+    def close(self):
+        pass
+
+
+class JSONLSink:
+    ## Line-buffered, and flushed after every record, so that a run that
+    ## is killed (eg, for running out of memory) keeps all of its records.
+    def __init__(self, fileName, mode='a'):
+        self.f = open(fileName, mode, 1)
+
+    def write(self, record):
+        ## (numpy scalars that json doesn't know are written as floats.)
+        self.f.write(json.dumps(record, default=float) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class RingSink:
+    def __init__(self, size=10000):
+        self.records = deque(maxlen=size)
+
+    def write(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+
+class ConsoleSink:
+    def __init__(self, interval=5.0, always=(), stream=None):
+        self.interval = interval
+        self.always = always
+        self.stream = stream
+        self.lastTime = 0.
+        self.skipped = 0
+
+    def write(self, record):
+        if record['kind'] not in self.always:
+            if record['time'] - self.lastTime < self.interval:
+                self.skipped += 1
+                return
+            self.lastTime = record['time']
+        stream = self.stream or sys.stdout
+        stream.write(formatRecord(record, self.skipped) + '\n')
+        stream.flush()
+        self.skipped = 0
+
+    def close(self):
+        pass
+
+
+class MultiSink:
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def write(self, record):
+        for sink in self.sinks:
+            sink.write(record)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def formatRecord(record, skipped=0):
+    fields = [ '%s=%s' % (name, formatValue(record[name])) for name in sorted(record)
+               if name not in ('kind', 'time') ]
+    line = '  [%s] %s' % (record['kind'], ' '.join(fields))
+    if skipped:
+        line += '  (%d more since the last)' % skipped
+    return line
+
+
+def formatValue(value):
+    if isinstance(value, float):
+        return '%.4g' % value
+    return str(value)
+
+
+sink = ConsoleSink()
+
+
+def setSinks(*sinks):
+    ## The old sink(s) are closed.
+    global sink
+    sink.close()
+    if len(sinks) == 1:
+        sink = sinks[0]
+    else:
+        sink = MultiSink(list(sinks))
+
+
+def close():
+    ## Closes the sink(s); records after this are thrown away.
+    setSinks(NullSink())
+
+
+def record(kind, **fields):
+    fields['kind'] = kind
+    fields['time'] = time.time()
+    sink.write(fields)
+
+
+def gflops(flops, seconds):
+    ## Achieved GFLOP/s, or None if it took no measurable time.
+    if seconds <= 0:
+        return None
+    return flops / seconds / 1e9
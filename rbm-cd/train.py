@@ -0,0 +1,378 @@
+#!/usr/bin/python
+
+## Copyright 2011, Wizcorp, www.wizcorp.jp
+
+
+## Pretraining and fine-tuning in one go, as a sequence of named stages:
+##
+##    layer0, layer1, layer2   - pretrain that layer with CD (as in step 1)
+##    finetune                 - backprop (as in step 2)
+##
+## Everything goes in one directory (--dir).  Every --checkpoint-every
+## epochs, and at the end of each stage, the state of the run is saved
+## there in checkpoint.nn:  the network's parameters, the CD momentum
+## (and the PCD chains) or the SGD velocity, the seed, and the stage and
+## epoch to carry on from.  Run the same command again after an
+## interruption, and it carries on from the last checkpoint;  as all
+## the random numbers come from the seed (see randomStreams.py), the
+## result is exactly the same as that of a run that wasn't interrupted.
+## (checkpoint.nn is also an ordinary network file, for nn.load().)
+##
+## Each layer's output for the training set, the next layer's input,
+## is kept in layer<n>out.npy, with a key (in layer<n>out.key) made from
+## the training set and the weights of the layers below.  It is reused
+## as long as the key matches, and otherwise recomputed.
+##
+## The memory used by each stage is reported at the end.  With
+## --memory-budget, fine-tuning's layer-2 feature cache, backprop's chunk
+## size and the evaluation batch size are chosen to fit it (see
+## memoryUtils.py).  (The layers' outputs are always on disk here.)
+##
+## For example:
+##    python train.py                          # start, or carry on
+##    python train.py --restart --seed 1       # start again
+##    python train.py --stages layer0,layer1   # just those stages
+##    python train.py --stages finetune --init nnData/NN_afterPreTrain.nn
+
+import os
+import sys
+import time
+import hashlib
+import multiprocessing
+from optparse import OptionParser
+import numpy as np
+
+import NeuralNetwork
+import telemetry
+import minimize as cg
+from lbfgs import lbfgs
+from backprop import backprop, backprop_only3
+from ChunkedGradient import ChunkedGradient
+from batchCD1 import batchCD1
+from CDSampler import CDSampler
+from sgdFineTune import SGDFineTuner, learningRateSchedule
+from Evaluator import Evaluator
+from checkpointUtils import saveArrays, loadArrays
+from datasetUtils import loadDataset, numClassesOf, BatchLoader, RecognitionSource, prefetch
+from randomStreams import batchStream
+from memoryUtils import MemoryTracker, planMemory, printPlan, parseBytes
+
+STAGES = ['layer0', 'layer1', 'layer2', 'finetune']
+
+
+def parseOptions(args):
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option('--dir', default='nnData/run',
+                      help="directory for the checkpoint and the layers' outputs [%default]")
+    parser.add_option('--stages', default=','.join(STAGES),
+                      help="the stages to run, from %s [%%default]" % ', '.join(STAGES))
+    parser.add_option('--restart', action='store_true', default=False,
+                      help="ignore any checkpoint, and start again")
+    parser.add_option('--init', default=None,
+                      help="start from this network, instead of a new one")
+    parser.add_option('--checkpoint-every', type='int', default=1, dest='checkpointEvery',
+                      help="epochs between checkpoints [%default]")
+    parser.add_option('--seed', type='int', default=None,
+                      help="random seed (by default, a new one is chosen and saved)")
+    parser.add_option('--float32', action='store_true', default=False,
+                      help="train in single precision")
+    parser.add_option('--train', default='../datasets/MNIST/trainImagesAndTargets',
+                      help="training set [%default]")
+    parser.add_option('--test', default='../datasets/MNIST/testImagesAndTargets',
+                      help="test set [%default]")
+    parser.add_option('--telemetry', default=None,
+                      help="also write every progress record to this JSONL file")
+    parser.add_option('--progress-interval', type='float', default=5.0, dest='progressInterval',
+                      help="seconds between progress lines [%default]")
+    parser.add_option('--memory-budget', default=None, dest='memoryBudget',
+                      help="fit fine-tuning in this much memory, eg 4G")
+    parser.add_option('--hidden', default='500,500,2000',
+                      help="sizes of the hidden layers [%default]")
+    parser.add_option('--pretrain-epochs', type='int', default=5, dest='pretrainEpochs')
+    parser.add_option('--batchsize', type='int', default=100,
+                      help="pretraining batch size [%default]")
+    parser.add_option('--cd-steps', type='int', default=1, dest='cdSteps')
+    parser.add_option('--persistent', action='store_true', default=False,
+                      help="persistent CD")
+    parser.add_option('--finetune-epochs', type='int', default=10, dest='fineTuneEpochs')
+    parser.add_option('--optimizer', default='cg',
+                      help="fine-tuning with 'cg', 'lbfgs' or 'sgd' [%default]")
+    parser.add_option('--learning-rate', type='float', default=0.1, dest='learningRate',
+                      help="initial SGD learning rate [%default]")
+    (options, args) = parser.parse_args(args)
+    if args:
+        parser.error("unexpected arguments:  %s" % ' '.join(args))
+    options.stages = options.stages.split(',')
+    for stage in options.stages:
+        if stage not in STAGES:
+            parser.error("unknown stage:  %s" % stage)
+    if options.optimizer not in ('cg', 'lbfgs', 'sgd'):
+        parser.error("unknown optimizer:  %s" % options.optimizer)
+    if options.memoryBudget:
+        try:
+            options.memoryBudget = parseBytes(options.memoryBudget)
+        except ValueError:
+            parser.error("bad memory budget:  %s" % options.memoryBudget)
+    return options
+
+
+class Trainer:
+    def __init__(self, options):
+        self.options = options
+        self.dir = options.dir
+        self.checkpointFile = os.path.join(self.dir, 'checkpoint.nn')
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+
+        dtype = np.float32 if options.float32 else np.float64
+        self.nn = NeuralNetwork.LogisticHinton2006(dtype)
+        (self.trainImages, self.trainLabels) = loadDataset(options.train)
+        assert self.trainImages.shape[0] == self.trainLabels.shape[0]
+        self.numClasses = numClassesOf(self.trainLabels)
+        self.state = {}
+        self.memory = MemoryTracker()
+        self.plan = dict(featureCache=True, gradientChunkSize=None, evalBatchSize=1000)
+
+    #### Checkpoints:
+
+    def start(self):
+        ## Returns the stage (as an index into STAGES) and the epoch to
+        ## carry on from.
+        nn = self.nn
+        options = self.options
+        if os.path.exists(self.checkpointFile) and not options.restart:
+            nn.load(self.checkpointFile)
+            ## (Copied, as the file is replaced by the next checkpoint.)
+            self.state = dict([ (name, np.array(array)) for (name, array)
+                                in loadArrays(self.checkpointFile).items() ])
+            self.seed = int(self.state['seed'])
+            if options.seed is not None and options.seed != self.seed:
+                raise Exception("The checkpoint in %s has seed %d, not %d (use --restart)."
+                                % (self.dir, self.seed, options.seed))
+            (stage, epoch) = (int(self.state['stage']), int(self.state['epoch']))
+            print "Resuming from %s:  stage %s, epoch %d." % (
+                self.checkpointFile, (STAGES + ['done'])[stage], epoch)
+            return stage, epoch
+
+        if options.seed is None:
+            self.seed = np.random.randint(2**31)
+        else:
+            self.seed = options.seed
+        print "Starting a new run, with seed %d." % self.seed
+        np.random.seed(self.seed)
+        if options.init:
+            nn.load(options.init)
+        else:
+            hidden = [ int(size) for size in options.hidden.split(',') ]
+            assert len(hidden) == 3, "Expecting 3 hidden layers."
+            nn.initRBM([self.trainImages.shape[1]] + hidden + [self.numClasses])
+        return 0, 0
+
+    def saveCheckpoint(self, stage, epoch, names=[], arrays=[]):
+        ## (saveArrays writes a temporary file first, so that there is
+        ## always a whole checkpoint on disk, even if we are stopped half way.)
+        names = ['layerSizes', 'parameters', 'seed', 'stage', 'epoch'] + names
+        arrays = [np.array(self.nn.layerSizes), self.nn.parameters,
+                  np.array(self.seed), np.array(stage), np.array(epoch)] + arrays
+        saveArrays(self.checkpointFile, names, arrays)
+
+    def checkpointDue(self, epoch, maxepoch):
+        ## After 'epoch':  the end of the stage has its own checkpoint.
+        return (epoch + 1) % self.options.checkpointEvery == 0 and epoch + 1 < maxepoch
+
+    #### The layers' outputs:
+
+    def outputKey(self, layer):
+        ## Depends on the training set and on layers 0 .. layer.
+        key = hashlib.sha1()
+        key.update(repr((os.path.abspath(self.options.train), self.trainImages.shape,
+                         np.dtype(self.nn.dtype).str)))
+        for l in range(layer + 1):
+            key.update(np.ascontiguousarray(self.nn.W[l]).data)
+            key.update(np.ascontiguousarray(self.nn.hB[l]).data)
+        return key.hexdigest()
+
+    def outputFiles(self, layer):
+        base = os.path.join(self.dir, 'layer%dout' % layer)
+        return base + '.npy', base + '.key'
+
+    def layerOutput(self, layer):
+        ## The output of layers 0 .. layer, recomputed if it is missing or
+        ## out of date.
+        (outputFile, keyFile) = self.outputFiles(layer)
+        key = self.outputKey(layer)
+        if os.path.exists(outputFile) and os.path.exists(keyFile) \
+               and open(keyFile).read() == key:
+            print "Reusing the output of layer %d, in %s." % (layer, outputFile)
+        else:
+            print "Computing the output of layer %d, into %s." % (layer, outputFile)
+            source = RecognitionSource(self.nn, layer + 1, self.trainImages)
+            output = np.lib.format.open_memmap(outputFile, mode='w+', dtype=self.nn.dtype,
+                                               shape=(source.numCases, source.numDims))
+            for (where, batch) in source.batches(1000):
+                output[where] = batch
+            output.flush()
+            del output
+            self.writeKey(layer)
+        return np.load(outputFile, mmap_mode='r')
+
+    def writeKey(self, layer):
+        (outputFile, keyFile) = self.outputFiles(layer)
+        f = open(keyFile, 'w')
+        f.write(self.outputKey(layer))
+        f.close()
+
+    #### The stages:
+
+    def pretrain(self, layer, startEpoch):
+        nn = self.nn
+        options = self.options
+        stage = STAGES.index('layer%d' % layer)
+        if layer == 0:
+            inputData = self.trainImages
+        else:
+            inputData = self.layerOutput(layer - 1)
+
+        sampler = CDSampler(nn, layer, options.batchsize, options.cdSteps, options.persistent)
+        if startEpoch > 0:
+            sampler.setState(self.state)
+
+        def epochDone(epoch, sampler):
+            if self.checkpointDue(epoch, options.pretrainEpochs):
+                self.saveCheckpoint(stage, epoch + 1, CDSampler.stateNames, sampler.getState())
+                print "Checkpoint saved after epoch %d." % epoch
+
+        ## (Layer 2's output is the input of fine-tuning, which computes it
+        ## itself, from the trained layers.)
+        (outputFile, keyFile) = self.outputFiles(layer)
+        if os.path.exists(keyFile):
+            os.remove(keyFile)
+        if layer < 2:
+            output = dict(hidProbsFile=outputFile)
+        else:
+            output = dict(keepHidProbs=False)
+        batchCD1(nn, layer, inputData, options.pretrainEpochs, seed=self.seed,
+                 batchsize=options.batchsize, shuffle=True, k=options.cdSteps,
+                 persistent=options.persistent, prefetchBatches=True,
+                 startEpoch=startEpoch, sampler=sampler, epochDone=epochDone, **output)
+        if layer < 2 and startEpoch < options.pretrainEpochs:
+            self.writeKey(layer)
+
+        if layer == 2:
+            ## Give layer3 some random biases (from their own stream, so
+            ## they don't depend on where we resumed):
+            rng = batchStream(self.seed, 3, 0)
+            nn.vB[3][...] = 0.1*rng.standard_normal(nn.vB[3].shape)
+            nn.hB[3][...] = 0.1*rng.standard_normal(nn.hB[3].shape)
+            nn.save(os.path.join(self.dir, 'NN_afterPreTrain.nn'))
+        self.saveCheckpoint(stage + 1, 0)
+
+    def fineTune(self, startEpoch):
+        nn = self.nn
+        options = self.options
+        stage = STAGES.index('finetune')
+        maxepoch = options.fineTuneEpochs
+        (testImages, testLabels) = loadDataset(options.test)
+        plan = self.plan
+        evaluator = Evaluator(nn, plan['evalBatchSize'])
+        if plan['gradientChunkSize']:
+            layer3Gradient = ChunkedGradient(backprop_only3, plan['gradientChunkSize'])
+            allLayersGradient = ChunkedGradient(backprop, plan['gradientChunkSize'])
+        else:
+            layer3Gradient = backprop_only3
+            allLayersGradient = backprop
+
+        if options.optimizer == 'sgd':
+            tuner = SGDFineTuner(nn)
+            if startEpoch > 0:
+                tuner.velocity[...] = self.state['sgdVelocity']
+            loader = BatchLoader(self.trainImages, self.trainLabels, 100, self.numClasses,
+                                 nn.dtype)
+        else:
+            if options.optimizer == 'lbfgs':
+                optimizer = lbfgs
+            else:
+                optimizer = cg.minimize
+            loader = BatchLoader(self.trainImages, self.trainLabels, 1000, self.numClasses,
+                                 nn.dtype)
+
+        for epoch in xrange(startEpoch, maxepoch):
+            print "Fine-tuning, epoch", epoch
+            ## At first, we only update the final layer:
+            onlyLayer3 = (epoch < 5)
+            if options.optimizer == 'sgd':
+                learningRate = learningRateSchedule(epoch, options.learningRate, 0.9)
+                tuner.epoch(loader, learningRate, onlyLayer3, plan['featureCache'])
+            else:
+                batches = prefetch(loader.getBatch(batch) for batch in xrange(loader.numbatches))
+                for (batch, (data, targets)) in enumerate(batches):
+                    if onlyLayer3:
+                        nn.minimizeLayer3(data, targets, 3,
+                                          cacheKey=(batch if plan['featureCache'] else None),
+                                          optimizer=optimizer, gradient=layer3Gradient)
+                    else:
+                        nn.minimizeAllLayers(data, targets, 3, optimizer=optimizer,
+                                             gradient=allLayersGradient)
+
+            (numErrors, crossEntropy, numCases) = evaluator.evaluate(testImages, testLabels)
+            print "  Test set:  misclassified %d out of %d images.  (%.2f%% error)" % (
+                numErrors, numCases, 100. * numErrors / numCases)
+
+            if self.checkpointDue(epoch, maxepoch):
+                if options.optimizer == 'sgd':
+                    self.saveCheckpoint(stage, epoch + 1, ['sgdVelocity'], [tuner.velocity])
+                else:
+                    self.saveCheckpoint(stage, epoch + 1)
+                print "Checkpoint saved after epoch %d." % epoch
+
+        nn.save(os.path.join(self.dir, 'NN_afterBackprop.nn'))
+        self.saveCheckpoint(stage + 1, 0)
+
+    def run(self):
+        (stage, epoch) = self.start()
+        budget = self.options.memoryBudget
+        if budget:
+            if self.options.optimizer == 'sgd':
+                fineTuneBatchSize = 100
+            else:
+                fineTuneBatchSize = 1000
+            ## (The Evaluator has a thread per core, and the layers'
+            ## outputs are always spilled here.)
+            self.plan = planMemory(budget, self.trainImages.shape[0], self.nn.layerSizes,
+                                   self.nn.dtype, self.options.batchsize, fineTuneBatchSize,
+                                   evalThreads=multiprocessing.cpu_count(),
+                                   layerOutputs='spill')
+            printPlan(self.plan, budget)
+        for (s, name) in enumerate(STAGES):
+            if name not in self.options.stages:
+                continue
+            if s < stage:
+                print "Stage %s is already done." % name
+                continue
+            if s > stage:
+                epoch = 0                       # (the checkpoint is for an earlier stage)
+            print
+            print " === Stage %s === " % name
+            tStart = time.time()
+            self.memory.start(name)
+            if name == 'finetune':
+                self.fineTune(epoch)
+            else:
+                self.pretrain(STAGES.index(name), epoch)
+            self.memory.stop()
+            print "Stage %s took %.1f seconds." % (name, time.time() - tStart)
+            (stage, epoch) = (s + 1, 0)
+        print
+        self.memory.report()
+
+
+if __name__ == '__main__':
+    options = parseOptions(sys.argv[1:])
+    sinks = [telemetry.ConsoleSink(options.progressInterval)]
+    if options.telemetry:
+        sinks.append(telemetry.JSONLSink(options.telemetry))
+    telemetry.setSinks(*sinks)
+    try:
+        Trainer(options).run()
+    finally:
+        telemetry.close()